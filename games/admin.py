@@ -61,3 +61,4 @@ class GameAdmin(admin.ModelAdmin):
 @admin.register(Player)
 class PlayerAdmin(admin.ModelAdmin):
     list_display = ['nickname', 'anonymous_user_id', 'user', 'created']
+    raw_id_fields = ['seen_images']
@@ -0,0 +1,213 @@
+import datetime as dt
+import heapq
+import json
+import logging
+import time
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .engine import StaleGameError, answer_submitted, tick
+from .models import Game, GameStatus
+from .state import GameState, acquire_lease, release_lease
+from .utils import GAME_CLOCK_QUEUE, redis_client
+
+# Longest the clock sleeps when no game is waiting on it. Anything new arrives
+# through the queue and wakes the clock straight away, this only bounds how
+# long a stuck connection can go unnoticed.
+IDLE_WAIT = 30
+
+# How soon to try again when another clock was holding a game's lease.
+LEASE_RETRY = 1
+
+# A game whose tick failed is tried again after LEASE_RETRY seconds, twice as
+# long each time it fails again, up to this many seconds.
+MAX_RETRY_WAIT = 60
+
+logger = logging.getLogger(__name__)
+
+
+class GameClock:
+    """Drives every running game from a single deadline heap.
+
+    Each running game has exactly one live entry in the heap, keyed on the
+    time it next needs to be ticked. Rescheduling a game pushes a new entry
+    and leaves the old one behind, which is skipped when it comes up.
+    """
+
+    def __init__(self):
+        self.deadlines = []
+        self.scheduled = {}
+        self.answered = set()
+        self.recheck = set()
+        self.failures = {}
+
+    def schedule(self, game_id, when):
+        self.scheduled[game_id] = when
+        heapq.heappush(self.deadlines, (when, game_id))
+
+    def due(self, now):
+        game_ids = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            when, game_id = heapq.heappop(self.deadlines)
+            if self.scheduled.get(game_id) == when:
+                del self.scheduled[game_id]
+                game_ids.append(game_id)
+
+        return game_ids
+
+    def seconds_until_next(self, now):
+        while self.deadlines:
+            when, game_id = self.deadlines[0]
+            if self.scheduled.get(game_id) == when:
+                return max((when - now).total_seconds(), 0)
+            heapq.heappop(self.deadlines)
+
+        return IDLE_WAIT
+
+    def retry(self, game_id, wait=LEASE_RETRY):
+        when = timezone.now() + dt.timedelta(seconds=wait)
+        if self.scheduled.get(game_id, when) >= when:
+            self.schedule(game_id, when)
+
+    def back_off(self, game_id):
+        failures = self.failures[game_id] = self.failures.get(game_id, 0) + 1
+        self.retry(game_id,
+                   min(LEASE_RETRY * 2 ** (failures - 1), MAX_RETRY_WAIT))
+
+    def _step(self, game_ids, step, load):
+        # Games are only loaded once their lease is held, so whatever another
+        # clock did to them before releasing it is already visible.
+        leased = []
+        for game_id in game_ids:
+            if acquire_lease(game_id):
+                leased.append(game_id)
+            else:
+                self.retry(game_id)
+
+        failed = []
+        try:
+            try:
+                games = load(leased)
+            except Exception:
+                logger.exception("Loading games %s failed", leased)
+                games = []
+                failed = list(leased)
+
+            for game in games:
+                try:
+                    next_tick = step(game)
+                except StaleGameError:
+                    next_tick = timezone.now()
+                except Exception:
+                    logger.exception("%s failed for game %s", step.__name__,
+                                     game.id)
+                    failed.append(game.id)
+                    continue
+
+                self.failures.pop(game.id, None)
+                if next_tick:
+                    self.schedule(game.id, next_tick)
+        finally:
+            for game_id in leased:
+                release_lease(game_id)
+
+        for game_id in failed:
+            self.back_off(game_id)
+
+        return leased, failed
+
+    def advance(self, game_ids):
+        # Answers that couldn't be checked before are checked again when the
+        # game's retry comes up, a tick alone won't end a phase early.
+        recheck = self.recheck.intersection(game_ids)
+        if recheck:
+            self.recheck -= recheck
+            self.check_answers(recheck)
+            game_ids = [id for id in game_ids if id not in self.recheck]
+
+        self._step(game_ids, tick, self._load_for_tick)
+
+    def check_answers(self, game_ids):
+        leased, failed = self._step(game_ids, answer_submitted,
+                                    self._load_for_answers)
+        self.answered.update(set(game_ids) - set(leased))
+        self.recheck.update(failed)
+
+    def _load_for_tick(self, game_ids):
+        # Games that are only counting down can be ticked from their cached
+        # state, everything else needs its row.
+        now = timezone.now()
+        counting_down = [state for state in GameState.get_many(game_ids)
+                         .values() if state.counting_down(now)]
+        skip = {state.id for state in counting_down}
+
+        return counting_down + self._games(game_ids, skip)
+
+    def _load_for_answers(self, game_ids):
+        waiting = {state.id for state in GameState.get_many(game_ids).values()
+                   if state.waiting_on_players()}
+
+        return self._games(game_ids, waiting)
+
+    def _games(self, game_ids, skip):
+        game_ids = [id for id in game_ids if id not in skip]
+        return list(Game.objects.filter(pk__in=game_ids)) if game_ids else []
+
+    def load_running_games(self):
+        """Pick up every running game where it left off.
+
+        Run when the clock starts, so games carry on from their deadlines
+        after a restart or a crash instead of being stranded.
+        """
+        running = (Game.objects
+                   .exclude(status__in=[GameStatus.STARTING,
+                                        GameStatus.COMPLETE,
+                                        GameStatus.ABANDONED])
+                   .values_list('id', 'next_update'))
+        now = timezone.now()
+        for game_id, next_update in running:
+            self.schedule(game_id, next_update or now)
+
+    def receive(self, message):
+        data = json.loads(message)
+        if data.get('event') == 'answer':
+            self.answered.add(data['game_id'])
+        else:
+            when = dt.datetime.fromtimestamp(data['at'], tz=dt.timezone.utc)
+            self.schedule(data['game_id'], when)
+
+    def wait_for_messages(self, timeout):
+        client = redis_client()
+        if timeout > 0:
+            item = client.blpop(GAME_CLOCK_QUEUE, timeout=timeout)
+            if not item:
+                return
+            self.receive(item[1])
+
+        message = client.lpop(GAME_CLOCK_QUEUE)
+        while message:
+            self.receive(message)
+            message = client.lpop(GAME_CLOCK_QUEUE)
+
+    def run(self):
+        self.load_running_games()
+
+        while True:
+            try:
+                self.wait_for_messages(
+                    self.seconds_until_next(timezone.now()))
+            except Exception:
+                # Without the queue the clock still keeps the deadlines it
+                # already has, it just hears about new ones late.
+                logger.exception("Reading the game clock queue failed")
+                time.sleep(LEASE_RETRY)
+
+            close_old_connections()
+            if self.answered:
+                answered, self.answered = self.answered, set()
+                self.check_answers(answered)
+
+            due = self.due(timezone.now())
+            if due:
+                self.advance(due)
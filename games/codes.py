@@ -0,0 +1,81 @@
+import itertools
+import random
+import string
+
+from .models import Game, GameStatus
+from .utils import redis_client
+
+CODE_POOL = 'game_codes'
+CODE_LENGTH = 4
+# The length of the codes in the pool, once it has been filled.
+POOL_LENGTH = f"{CODE_POOL}:length"
+
+FILL_BATCH = 10000
+
+
+def _held_games():
+    # A finished game keeps its code until it's closed, so its players can
+    # start another game under the same one.
+    return (Game.objects
+            .exclude(status=GameStatus.ABANDONED)
+            .exclude(status=GameStatus.COMPLETE, closed=True))
+
+
+def _random_code(length):
+    return ''.join(random.choices(string.ascii_uppercase, k=length))
+
+
+def allocate_game_code():
+    """Take a free code for a new game.
+
+    Codes come out of a Redis set, which SPOP empties one random member at a
+    time, so two games can never be handed the same code. If the pool hasn't
+    been filled yet this falls back to guessing until a free code turns up.
+    """
+    client = redis_client()
+    code = client.spop(CODE_POOL)
+    if code:
+        return code.decode()
+
+    length = int(client.get(POOL_LENGTH) or CODE_LENGTH)
+    code = _random_code(length)
+    while _held_games().filter(code=code).exists():
+        code = _random_code(length)
+
+    return code
+
+
+def release_game_code(code):
+    """Put a code back in the pool once no game is holding on to it."""
+    if not _held_games().filter(code=code).exists():
+        redis_client().sadd(CODE_POOL, code)
+
+
+def fill_code_pool(length=CODE_LENGTH):
+    """Reset the pool to every code of the given length no game is holding.
+
+    The new pool is built under a separate key and renamed into place, so
+    games can keep being created while it fills. Codes those games took are
+    taken back out of it afterwards.
+    """
+    held = set(_held_games().values_list('code', flat=True))
+    client = redis_client()
+    filling = f"{CODE_POOL}:filling"
+    client.delete(filling)
+
+    letters = itertools.product(string.ascii_uppercase, repeat=length)
+    codes = (''.join(code) for code in letters)
+    free = (code for code in codes if code not in held)
+    count = 0
+    while batch := list(itertools.islice(free, FILL_BATCH)):
+        client.sadd(filling, *batch)
+        count += len(batch)
+
+    client.rename(filling, CODE_POOL)
+    client.set(POOL_LENGTH, length)
+
+    held = list(_held_games().values_list('code', flat=True))
+    for start in range(0, len(held), FILL_BATCH):
+        count -= client.srem(CODE_POOL, *held[start:start + FILL_BATCH])
+
+    return count
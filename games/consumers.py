@@ -1,105 +1,188 @@
+import asyncio
 import json
+import logging
+from collections import Counter
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.db.models import Q
 from django.template import loader
+from django.utils import timezone
 
+from games.fragments import cached_shared_context, render_game_content
 from games.models import Game, GameStatus, Player
-from games.utils import running_game_context
+from games.players import player_from_cookie
+from games.utils import epoch_ms, player_group
 
+# Refreshes that arrive this close together are sent as one frame, rendered
+# from the latest of them.
+REFRESH_WINDOW = 0.03
 
-class RunningGameConsumer(WebsocketConsumer):
-    def connect(self):
-        player_id = self.scope['cookies'].get('player_id')
+# Totals for every socket in this process. Refreshes received minus sent is
+# how many were merged, countdowns that were already covered by a pending
+# refresh are skipped.
+refresh_stats = Counter()
+
+logger = logging.getLogger(__name__)
+
+
+class RunningGameConsumer(AsyncWebsocketConsumer):
+    """Pushes a running game's updates to one player's socket.
+
+    Handlers only leave the event loop for the database, and each of them
+    does all of its queries in a single trip to the thread pool, so idle
+    sockets cost nothing but their coroutine.
+    """
+
+    game = None
+    refresh_event = None
+    refresh_task = None
+
+    async def connect(self):
+        cookies = self.scope['cookies']
         code = self.scope['url_route']['kwargs'].get('code')
 
-        self.player = Player.objects.get(anonymous_user_id=player_id)
-        self.game = (Game.objects
-                     .filter(code=code, players=self.player)
-                     .exclude(closed=True)
-                     .order_by('-created')
-                     .first())
+        self.player, self.game = await self._load_player_and_game(cookies,
+                                                                  code)
 
         if self.game and self.player:
-            async_to_sync(self.channel_layer.group_add)(self.game.code,
-                                                        self.channel_name)
-            self.accept()
+            for group in self._groups():
+                await self.channel_layer.group_add(group, self.channel_name)
+            await self.accept()
+        else:
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if self.refresh_task:
+            self.refresh_task.cancel()
 
-    def disconnect(self, close_code):
         if self.game:
-            async_to_sync(self.channel_layer.group_discard)(self.game.code,
-                                                            self.channel_name)
+            for group in self._groups():
+                await self.channel_layer.group_discard(group,
+                                                       self.channel_name)
+
+    def _groups(self):
+        return [self.game.code, player_group(self.game.code, self.player.id)]
 
-    def receive(self, text_data):
+    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message = text_data_json.get("message", "")
 
         if message.lower() == 'ping':
-            self.send(text_data=json.dumps({"message": "pong"}))
+            await self.send(text_data=json.dumps({"message": "pong"}))
         else:
-            self.send(text_data=json.dumps({"message": message}))
-
-    def countdown_update(self, event):
-        remaining = event.get("remaining", '')
-        class_name = "text-red-800" if remaining and int(remaining) <= 5 else ""
-        class_name += " min-h-lg"
-        html = f'<p id="countdown_time" hx-swap-oob="true" class="{class_name}">{remaining}</p>'
-        self.send(text_data=html)
-
-    def refresh_game_content(self, event):
-        self.game.refresh_from_db()
-        context = running_game_context(self.game, self.player)
-        template = loader.get_template('game_content.html')
-        html = template.render(context, None)
+            await self.send(text_data=json.dumps({"message": message}))
+
+    async def countdown_update(self, event):
+        if self.refresh_event:
+            # The refresh about to go out carries the deadline as well.
+            refresh_stats['countdowns_skipped'] += 1
+            return
+
+        context = {
+            'oob': True,
+            'class_name': "min-h-lg",
+            'deadline': event.get("deadline", ''),
+            'server_now': epoch_ms(timezone.now()),
+        }
+        template = loader.get_template('countdown.html')
+        await self.send(text_data=template.render(context, None))
+
+    async def refresh_game_content(self, event):
+        refresh_stats['received'] += 1
+        self.refresh_event = event
+
+        if not self.refresh_task:
+            self.refresh_task = asyncio.create_task(self._send_refreshes())
+
+    async def _send_refreshes(self):
+        # Anything arriving while a refresh is being sent waits for the next
+        # window, so frames always go out in the order they were sent.
+        try:
+            while self.refresh_event:
+                await asyncio.sleep(REFRESH_WINDOW)
+                event, self.refresh_event = self.refresh_event, None
+                await self._send_refresh(event)
+                refresh_stats['sent'] += 1
+        except Exception:
+            logger.exception("Refresh failed for game %s", self.game.code)
+        finally:
+            self.refresh_task = None
+
+    async def _send_refresh(self, event):
+        # The sender normally ships the part of the page every player shares,
+        # leaving only this player's part to fill in here.
+        shared = event.get('context')
+        if shared:
+            _, html = render_game_content(shared, self.player)
+        else:
+            html = await self._render_game_content()
 
         html = f'<div id="game_content" hx-swap-oob="true"> { html } </div>'
 
-        self.send(text_data=html)
+        await self.send(text_data=html)
 
-    def player_added(self, event):
+    async def player_added(self, event):
         player = event.get("player", "")
 
         if player:
             html = ('<div hx-swap-oob="beforeend:#player-list">'
                     f'<li>{player}</li></div>')
-            self.send(text_data=html)
-
-        if self.game.owner == self.player:
-            count = self.game.players.count()
-            context = {
-                'enough_players': count > 1,
-                'game_full': count >= 8,
-                'code': self.game.code,
-            }
-            template = loader.get_template('owner_start_message.html')
-            html = template.render(context, None)
-            html = (f'<div id="owner_message" hx-swap-oob="true"> { html } '
-                    '</div>')
-
-            self.send(text_data=html)
-
-    def new_game(self, event):
-        self.game = (Game.objects
-                     .exclude(Q(status=GameStatus.COMPLETE) |
-                              Q(status=GameStatus.ABANDONED))
-                     .filter(code=self.game.code)
-                     .first())
-
-    def close_game(self, event):
+            await self.send(text_data=html)
+
+    async def owner_message(self, event):
+        await self.send(text_data=event["html"])
+
+    async def new_game(self, event):
+        self.game = await self._load_new_game()
+
+    async def close_game(self, event):
         template = loader.get_template('game_closed.html')
         html = template.render({}, None)
 
         html = f'<div id="finished_game_message" hx-swap-oob="true"> { html } </div>'
-        self.send(text_data=html)
+        await self.send(text_data=html)
 
-        self.disconnect(None)
+        await self.disconnect(None)
 
-    def cancel_game(self, event):
+    async def cancel_game(self, event):
         template = loader.get_template('game_closed.html')
         html = template.render({'cancelled': True}, None)
 
         html = f'<div id="game_content" hx-swap-oob="true"> { html } </div>'
-        self.send(text_data=html)
-
-        self.disconnect(None)
+        await self.send(text_data=html)
+
+        await self.disconnect(None)
+
+    @database_sync_to_async
+    def _load_player_and_game(self, cookies, code):
+        player = (player_from_cookie(cookies) or
+                  Player.objects.filter(anonymous_user_id=cookies.get(
+                      'player_id')).first())
+        if not player:
+            return None, None
+
+        game = (Game.objects
+                .filter(code=code, players=player)
+                .exclude(closed=True)
+                .order_by('-created')
+                .first())
+
+        return player, game
+
+    @database_sync_to_async
+    def _render_game_content(self):
+        # Only used when an event comes without the game's context, which
+        # then has to be loaded here.
+        self.game.refresh_from_db()
+        _, html = render_game_content(cached_shared_context(self.game),
+                                      self.player)
+        return html
+
+    @database_sync_to_async
+    def _load_new_game(self):
+        return (Game.objects
+                .exclude(Q(status=GameStatus.COMPLETE) |
+                         Q(status=GameStatus.ABANDONED))
+                .filter(code=self.game.code)
+                .first())
@@ -1,73 +1,164 @@
 import datetime as dt
+import logging
 import random
 
-from celery import Celery
-from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Max, Min
 from django.utils import timezone
 from images.models import Image
 
-from games.models import Game, GameStatus, Vote
+from games.models import (Game, GameStatus, Guess, Player, Round, Vote,
+                          normalize_guess)
 
-from .utils import guesses_with_votes, send_channel_message, status
+from .state import GameState
+from .utils import (epoch_ms, final_results, game_content_event,
+                    notify_game_clock, reveal_script, send_channel_message,
+                    standings, status)
 
 GUESS_TIME = 60
 VOTE_TIME = 30
+REVEAL_TIME = 5
 ROUNDS = 5
 
+# Players count down to the deadline locally, this is how often the clock
+# resends it to correct for drift.
+COUNTDOWN_SYNC_TIME = 15
 
-app = Celery('games.engine', broker=settings.REDIS_URL)
+# Random ids drawn per image wanted when sampling them, and how many times
+# the draws are made before the rest of the library is shuffled instead.
+SAMPLE_DRAWS = 4
+SAMPLE_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class StaleGameError(Exception):
+    """Another tick moved the game on after this copy of it was loaded."""
+
+
+def _save(game, *fields):
+    """Write the changed fields and refresh the game's cached state.
+
+    Every write bumps the game's version and only applies if the version is
+    still the one that was loaded, so a duplicate tick working from an old
+    copy raises StaleGameError instead of advancing the game a second time.
+    """
+    updated = (Game.objects
+               .filter(pk=game.pk, version=game.version)
+               .update(version=F('version') + 1,
+                       **{field: getattr(game, field) for field in fields}))
+    if not updated:
+        raise StaleGameError(game.id)
+
+    game.version += 1
+    # The row is written by now and the cached state is only a shortcut for
+    # the clock, so losing it mustn't stop players hearing about the change.
+    try:
+        if status(game) in ('guessing', 'voting', 'revealing'):
+            GameState.from_game(game).save()
+        else:
+            GameState.delete(game.id)
+    except Exception:
+        logger.exception("Couldn't cache the state of game %s", game.id)
+
+
+def _sample_images(images, count):
+    """Pick up to count random ids from images without listing them all.
+
+    Ids are drawn uniformly between the lowest and highest primary key and
+    kept if they're in images, so every image is as likely as any other.
+    Draws that hit a deleted or excluded image are made again, a few times,
+    before whatever is still missing is picked by shuffling the rest.
+    """
+    bounds = Image.objects.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+
+    picked = []
+    for _ in range(SAMPLE_ATTEMPTS):
+        if len(picked) >= count:
+            break
+
+        draws = {random.randint(bounds['low'], bounds['high'])
+                 for _ in range(count * SAMPLE_DRAWS)}
+        found = list(images.filter(pk__in=draws - set(picked))
+                     .values_list('pk', flat=True))
+        random.shuffle(found)
+        picked += found[:count - len(picked)]
+
+    if len(picked) < count:
+        picked += (images.exclude(pk__in=picked).order_by('?')
+                   .values_list('pk', flat=True)[:count - len(picked)])
+
+    return picked
 
 
 def _get_image_ids(game):
-    recent_games = (Game.objects
-                    .filter(status=GameStatus.COMPLETE,
-                            players__in=game.players.all())
-                    .order_by('-created'))
-    recent_images = recent_games.values_list('rounds__image__id', flat=True)
-    ids = list(Image.objects
-               .exclude(pk__in=recent_images)
-               .values_list('pk', flat=True))
+    unseen = Image.objects.exclude(seen_by__in=game.players.all())
+    ids = _sample_images(unseen, ROUNDS)
     if len(ids) < ROUNDS:
-        extras = list(Image.objects
-                      .exclude(pk__in=ids)
-                      .values_list('pk', flat=True))
-        extras = random.sample(extras, ROUNDS - len(ids))
+        extras = _sample_images(Image.objects.exclude(pk__in=ids),
+                                ROUNDS - len(ids))
         ids = extras + ids
 
-    return random.sample(ids, ROUNDS)
+    return random.sample(ids, len(ids))
+
+
+def _record_seen_images(game):
+    SeenImage = Player.seen_images.through
+    image_ids = list(game.rounds.values_list('image_id', flat=True))
+    SeenImage.objects.bulk_create(
+        [SeenImage(player_id=player_id, image_id=image_id)
+         for player_id in game.players.values_list('id', flat=True)
+         for image_id in image_ids],
+        ignore_conflicts=True)
+
+
+def create_rounds(game, image_ids):
+    """Create a round, with the real caption as its first guess, per image."""
+    images = Image.objects.in_bulk(image_ids)
+    rounds = Round.objects.bulk_create(
+        [Round(game=game, order=i + 1, image_id=id)
+         for i, id in enumerate(image_ids)])
+    Guess.objects.bulk_create(
+        [Guess(rownd=rownd, player=None, text=images[rownd.image_id].caption,
+               normalized_text=normalize_guess(
+                   images[rownd.image_id].caption))
+         for rownd in rounds])
 
+    return rounds
 
+
+@transaction.atomic
 def start_game(game, continue_timer=True):
     game.status = GameStatus.GUESSING_ONE
     game.next_update = timezone.now() + dt.timedelta(seconds=GUESS_TIME)
 
-    random_image_ids = _get_image_ids(game)
-    for i, id in enumerate(random_image_ids):
-        image = Image.objects.get(pk=id)
-        rownd = game.rounds.create(order=i + 1, image=image)
-        rownd.guesses.create(player=None, text=image.caption)
+    create_rounds(game, _get_image_ids(game))
 
-    player_list = {p.id: p.nickname for p in game.players.all()}
+    player_list = dict(game.players.values_list('id', 'nickname'))
     game.scoring_results = {
         'players': player_list,
         'round_totals': {}
     }
 
-    game.save()
+    _save(game, 'status', 'next_update', 'scoring_results')
 
     if continue_timer:
-        timer_tick.delay(game.id)
+        notify_game_clock(game.id)
 
 
 def guessing_update(game, ready_for_transition):
-    round_number = int(game.status[1])
-    rownd = game.rounds.get(order=round_number)
-    all_players_guessed = rownd.guesses.count() == game.players.count() + 1
+    if not ready_for_transition:
+        round_number = int(game.status[1])
+        rownd = game.rounds.get(order=round_number)
+        ready_for_transition = (rownd.guesses.count() ==
+                                game.players.count() + 1)
 
-    if all_players_guessed or ready_for_transition:
+    if ready_for_transition:
         game.status = 'V' + game.status[1]
         game.next_update = timezone.now() + dt.timedelta(seconds=VOTE_TIME)
-        game.save()
+        _save(game, 'status', 'next_update')
 
         return True
 
@@ -75,92 +166,150 @@ def guessing_update(game, ready_for_transition):
 def voting_update(game, ready_for_transition):
     round_number = int(game.status[1])
     rownd = game.rounds.get(order=round_number)
-    all_players_voted = (Vote.objects.filter(guess__rownd=rownd).count() ==
-                         game.players.count())
+    if not ready_for_transition:
+        ready_for_transition = (Vote.objects
+                                .filter(guess__rownd=rownd).count() ==
+                                game.players.count())
+
+    if ready_for_transition:
+        # The votes are all in, so every step of the reveal can be worked
+        # out now instead of on each of them.
+        rownd.reveal = reveal_script(rownd)
+        rownd.save(update_fields=['reveal'])
 
-    if all_players_voted or ready_for_transition:
         game.status = 'S' + game.status[1]
         game.reveal_step = 1
-        game.save()
+        game.next_update = timezone.now() + dt.timedelta(seconds=REVEAL_TIME)
+        _save(game, 'status', 'next_update', 'reveal_step')
 
         return True
 
 
-def compute_score(rownd, game):
-    round_scores = {p.id: 0 for p in game.players.all()}
+def _round_scores(rownd, game):
+    # Every vote in the round comes back in one query, with no author for the
+    # real caption. Picking it earns the voter two points, any other guess
+    # earns its author one per vote.
+    round_scores = {id: 0 for id in game.players.values_list('id',
+                                                             flat=True)}
 
-    correct_guess = rownd.guesses.filter(player=None).first()
+    for voter_id, author_id in rownd.votes.values_list('player_id',
+                                                       'guess__player_id'):
+        if author_id is None:
+            if voter_id in round_scores:
+                round_scores[voter_id] += 2
+        else:
+            round_scores[author_id] += 1
 
-    for player in game.players.all():
-        if correct_guess.votes.filter(player=player).exists():
-            round_scores[player.id] += 2
+    return round_scores
 
-    for guess in guesses_with_votes(rownd):
-        round_scores[guess.player.id] += guess.votes.count()
 
-    game.scoring_results['round_totals'][rownd.order] = round_scores
-    game.save()
+def _score_round(rownd, game):
+    round_scores = _round_scores(rownd, game)
+    scoring_results = game.scoring_results
+    # Rounds read back from the database are keyed on strings, a round
+    # scored again mustn't be counted under both.
+    scoring_results['round_totals'].pop(str(rownd.order), None)
+    scoring_results['round_totals'][rownd.order] = round_scores
+    scoring_results['standings'] = standings(scoring_results['round_totals'],
+                                             round_scores)
+
+
+def compute_score(rownd, game):
+    _score_round(rownd, game)
+    _save(game, 'scoring_results')
 
 
 def revealing_update(game):
     round_number = int(game.status[1])
     rownd = game.rounds.get(order=round_number)
 
+    fields = ['status', 'next_update', 'reveal_step']
     if game.reveal_step == 1:
-        compute_score(rownd, game)
+        _score_round(rownd, game)
+        fields.append('scoring_results')
 
-    guesses = guesses_with_votes(rownd)
+    script = rownd.reveal or reveal_script(rownd)
+    game.next_update = timezone.now() + dt.timedelta(seconds=REVEAL_TIME)
     if game.reveal_step >= 99:
         game.status = 'R' + str(round_number + 1)
         game.next_update = (timezone.now() +
                             dt.timedelta(seconds=GUESS_TIME))
-    elif game.reveal_step > guesses.count():
+    elif game.reveal_step >= len(script):
         game.reveal_step = 98
         if round_number >= ROUNDS:
             game.status = GameStatus.COMPLETE
+            game.scoring_results['final'] = final_results(game)
+            fields.append('scoring_results')
 
     game.reveal_step += 1
-    game.save()
+    _save(game, *fields)
+
+    if game.status == GameStatus.COMPLETE:
+        _record_seen_images(game)
+
     return True
 
 
-@app.task
-def timer_tick(game_id):
-    game = Game.objects.get(pk=game_id)
+def _next_tick(game):
+    _status = status(game)
+    now = timezone.now()
+    if _status in ('guessing', 'voting'):
+        return min(game.next_update,
+                   now + dt.timedelta(seconds=COUNTDOWN_SYNC_TIME))
+    elif _status == 'revealing':
+        return game.next_update
+
 
+def tick(game):
+    """Advance a game by one clock step.
+
+    Returns the time the game next needs to be ticked, or None once the game
+    no longer needs the clock. Ticking a game before its deadline does not
+    move it on, so duplicate ticks are harmless.
+    """
     _status = status(game)
-    tick_delay = None
+    status_change = False
     if _status == 'registering':
-        start_game(game)
-        seconds_remaining = (game.next_update - timezone.now()).total_seconds()
-
-        send_channel_message(game.code, {"type": "refresh_game_content"})
+        start_game(game, continue_timer=False)
+        status_change = True
+    elif game.next_update and game.next_update > timezone.now():
+        # Everyone having answered is handled by answer_submitted, so before
+        # the deadline the clock just resyncs the countdown players run
+        # locally.
+        if _status in ('guessing', 'voting'):
+            send_channel_message(game.code,
+                                 {"type": "countdown_update",
+                                  "deadline": epoch_ms(game.next_update)})
+    elif _status == 'guessing':
+        status_change = guessing_update(game, True)
+    elif _status == 'voting':
+        status_change = voting_update(game, True)
+    elif _status == 'revealing':
+        status_change = revealing_update(game)
+
+    if status_change:
+        send_channel_message(game.code, game_content_event(game))
+
+    return _next_tick(game)
+
+
+def answer_submitted(game):
+    """Check whether a new guess or vote finished the current phase.
+
+    Returns the time the game next needs to be ticked if it moved on, or None
+    if it is still waiting on other players.
+    """
+    _status = status(game)
+    if _status == 'guessing':
+        status_change = guessing_update(game, False)
+    elif _status == 'voting':
+        status_change = voting_update(game, False)
     else:
-        seconds_remaining = round((game.next_update - timezone.now())
-                                  .total_seconds())
-        ready_for_transition = seconds_remaining <= 0
-
-        status_change = False
-        if _status == 'guessing':
-            tick_delay = 1
-            status_change = guessing_update(game, ready_for_transition)
-        elif _status == 'voting':
-            status_change = voting_update(game, ready_for_transition)
-            tick_delay = 5 if status_change else 1
-            if status_change:
-                seconds_remaining = ""
-        elif _status == 'revealing':
-            status_change = revealing_update(game)
-            seconds_remaining = ""
-
-            if game.status != GameStatus.COMPLETE:
-                tick_delay = 5
-
-        if status_change:
-            send_channel_message(game.code, {"type": "refresh_game_content"})
-
-    send_channel_message(game.code, {"type": "countdown_update",
-                                     "remaining": seconds_remaining})
-
-    if tick_delay:
-        timer_tick.apply_async(args=[game.id], countdown=tick_delay)
+        return None
+
+    if not status_change:
+        return None
+
+    send_channel_message(game.code, game_content_event(game))
+
+    return _next_tick(game)
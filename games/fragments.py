@@ -0,0 +1,53 @@
+from django.core.cache import caches
+from django.template import loader
+from django.utils import timezone
+
+from .utils import epoch_ms, player_game_context, shared_game_context
+
+# Stands in for the server's clock in cached pages. It is filled in every
+# time a page is sent so countdowns still sync to the moment it went out.
+SERVER_NOW = '__server_now__'
+
+
+def _key(game_id, version, variant):
+    return f"game-{game_id}-{version}-{variant}"
+
+
+def _variant(context, player_id):
+    _status = context['status']
+    if _status == 'guessing':
+        return 'guessed' if context['already_guessed'] else 'guessing'
+    elif _status == 'voting':
+        # Everyone still voting sees the guesses in their own order.
+        return 'voted' if context['already_voted'] else f'voting-{player_id}'
+    elif _status == 'complete':
+        return 'owner' if context['is_owner'] else 'complete'
+
+    return _status
+
+
+def cached_shared_context(game):
+    return caches['fragments'].get_or_set(
+        _key(game.id, game.version, 'context'),
+        lambda: shared_game_context(game))
+
+
+def render_game_content(shared, current_player):
+    """Render the game_content.html a player should see.
+
+    Returns the player's context along with the page. Players who see the
+    same thing share one render for as long as the game's version stays the
+    same.
+    """
+    fragments = caches['fragments']
+    game_id, version = shared['game_id'], shared['version']
+    fragments.add(_key(game_id, version, 'context'), shared)
+
+    context = player_game_context(shared, current_player)
+    variant = _variant(context, current_player and current_player.id)
+    html = fragments.get_or_set(
+        _key(game_id, version, variant),
+        lambda: loader.get_template('game_content.html').render(
+            {**context, 'server_now': SERVER_NOW}, None))
+
+    return context, html.replace(SERVER_NOW, str(epoch_ms(timezone.now())))
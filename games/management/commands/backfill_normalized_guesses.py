@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from games.models import Guess, normalize_guess
+
+
+class Command(BaseCommand):
+
+    help = "Fill in normalized_text for guesses made before it existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        updated = skipped = 0
+
+        while True:
+            batch = list(Guess.objects
+                         .filter(pk__gt=last_pk, normalized_text='')
+                         .order_by('pk')[:options['batch_size']])
+            if not batch:
+                break
+
+            last_pk = batch[-1].pk
+            for guess in batch:
+                guess.normalized_text = normalize_guess(guess.text)
+
+            try:
+                with transaction.atomic():
+                    Guess.objects.bulk_update(batch, ['normalized_text'])
+                updated += len(batch)
+            except IntegrityError:
+                # Somewhere in the batch is a duplicate that got in before
+                # the constraint did. It keeps an empty normalized_text, the
+                # rest of the batch goes in one at a time.
+                for guess in batch:
+                    try:
+                        with transaction.atomic():
+                            (Guess.objects.filter(pk=guess.pk)
+                             .update(normalized_text=guess.normalized_text))
+                        updated += 1
+                    except IntegrityError:
+                        skipped += 1
+
+        self.stdout.write(f"Backfilled {updated} guesses, skipped {skipped} "
+                          "duplicates")
@@ -0,0 +1,135 @@
+import asyncio
+import resource
+import statistics
+import threading
+import time
+import uuid
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.sessions import CookieMiddleware
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.urls import re_path
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from games.consumers import REFRESH_WINDOW, refresh_stats
+from games.models import Game, GameStatus, Player
+from games.utils import game_content_event
+
+IN_MEMORY_LAYER = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+}
+
+# Generous enough that a slow consumer shows up in the numbers instead of
+# failing the run.
+TIMEOUT = 120
+
+
+class Command(BaseCommand):
+
+    help = ("Open many sockets to a game consumer and time how long it takes "
+            "to fan events out to all of them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=1000)
+        parser.add_argument('--events', type=int, default=10)
+        parser.add_argument('--consumer',
+                            default='games.consumers.RunningGameConsumer',
+                            help='dotted path of the consumer to benchmark')
+
+    def handle(self, *args, **options):
+        consumer = import_string(options['consumer'])
+        application = CookieMiddleware(URLRouter([
+            re_path(r"ws/game/(?P<code>\w+)/$", consumer.as_asgi()),
+        ]))
+
+        owner = Player.objects.create(nickname='bench owner')
+        game = Game.objects.create(code='BENCH', owner=owner,
+                                   status=GameStatus.GUESSING_ONE,
+                                   next_update=timezone.now())
+        players = Player.objects.bulk_create(
+            Player(nickname=f'bench {i}', anonymous_user_id=uuid.uuid4())
+            for i in range(options['sockets']))
+        game.players.add(owner, *players)
+
+        try:
+            with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER):
+                asyncio.run(self._run(application, game, players,
+                                      options['events']))
+        finally:
+            game.delete()
+            Player.objects.filter(
+                pk__in=[owner.pk] + [p.pk for p in players]).delete()
+
+    async def _run(self, application, game, players, events):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        sockets = await asyncio.gather(*(
+            self._connect(application, game, player) for player in players))
+        elapsed = time.perf_counter() - start
+        sockets = [socket for socket in sockets if socket]
+
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stdout.write(
+            f"{len(sockets)} sockets connected in {elapsed:.2f}s, "
+            f"{(rss_after - rss_before) / max(len(sockets), 1):.1f}KB each, "
+            f"{threading.active_count()} threads")
+
+        for event_type in ('countdown_update', 'refresh_game_content'):
+            timings = await self._fan_out(game, sockets, [event_type],
+                                          events)
+            self.stdout.write(
+                f"{event_type}: median {statistics.median(timings):.1f}ms, "
+                f"max {max(timings):.1f}ms to reach every socket")
+
+        # The end of a round: a transition right after the last answers,
+        # with a countdown resync landing in the middle.
+        timings = await self._fan_out(
+            game, sockets, ['refresh_game_content', 'countdown_update',
+                            'refresh_game_content'], events)
+        self.stdout.write(
+            f"refresh burst: median {statistics.median(timings):.1f}ms, "
+            f"max {max(timings):.1f}ms to reach every socket")
+
+        merged = refresh_stats['received'] - refresh_stats['sent']
+        self.stdout.write(f"{merged} refreshes merged, "
+                          f"{refresh_stats['countdowns_skipped']} "
+                          "countdowns skipped")
+
+        await asyncio.gather(*(socket.disconnect() for socket in sockets))
+
+    async def _connect(self, application, game, player):
+        cookie = f'player_id={player.anonymous_user_id}'.encode()
+        socket = WebsocketCommunicator(application, f"/ws/game/{game.code}/",
+                                       headers=[(b'cookie', cookie)])
+        connected, _ = await socket.connect(timeout=TIMEOUT)
+        return connected and socket
+
+    async def _fan_out(self, game, sockets, event_types, events):
+        channel_layer = get_channel_layer()
+        timings = []
+        for _ in range(events):
+            start = time.perf_counter()
+            refresh = await database_sync_to_async(game_content_event)(game)
+            for event_type in event_types:
+                event = {'type': event_type}
+                if event_type == 'refresh_game_content':
+                    event = refresh
+                await channel_layer.group_send(game.code, event)
+            await asyncio.gather(*(socket.receive_from(timeout=TIMEOUT)
+                                   for socket in sockets))
+            timings.append((time.perf_counter() - start) * 1000)
+
+            # Anything else the events produced would otherwise be counted
+            # against the next round.
+            await asyncio.gather(*(self._drain(socket) for socket in sockets))
+
+        return timings
+
+    async def _drain(self, socket):
+        while not await socket.receive_nothing(timeout=REFRESH_WINDOW * 2):
+            await socket.receive_from()
@@ -0,0 +1,120 @@
+import random
+import statistics
+import string
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from games.models import Game, GameStatus, Guess, Player, Round, Vote
+from games.utils import fetch_running_game
+from images.models import Image
+
+BATCH_SIZE = 10000
+
+# One game in this many is still running, the rest are long over.
+RUNNING_EVERY = 10
+
+GUESSES_PER_ROUND = 4
+
+
+class Command(BaseCommand):
+
+    help = ("Time the lookups every request makes against a large synthetic "
+            "database. Everything it creates is rolled back, run it before "
+            "and after migrating to compare.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=1000000)
+        parser.add_argument('--games', type=int, default=200000)
+        parser.add_argument('--lookups', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        image = Image.objects.first()
+        if not image:
+            raise CommandError("Load some images first, rounds need one")
+
+        with transaction.atomic():
+            start = time.perf_counter()
+            samples = self._populate(options['players'], options['games'],
+                                     image, options['lookups'])
+            self.stdout.write(f"Populated in {time.perf_counter() - start:.1f}s")
+
+            self._time_lookups(samples)
+            transaction.set_rollback(True)
+
+    def _populate(self, player_count, game_count, image, sample_size):
+        for offset in range(0, player_count, BATCH_SIZE):
+            Player.objects.bulk_create(
+                Player(nickname='bench')
+                for _ in range(min(BATCH_SIZE, player_count - offset)))
+
+        player_ids = list(Player.objects.filter(nickname='bench')
+                          .values_list('pk', flat=True))
+
+        for offset in range(0, game_count, BATCH_SIZE):
+            games = Game.objects.bulk_create(
+                Game(code=''.join(random.choices(string.ascii_uppercase,
+                                                 k=4)),
+                     owner_id=random.choice(player_ids),
+                     status=(GameStatus.GUESSING_ONE
+                             if i % RUNNING_EVERY == 0
+                             else GameStatus.COMPLETE))
+                for i in range(min(BATCH_SIZE, game_count - offset)))
+            rounds = Round.objects.bulk_create(
+                Round(game_id=game.pk, order=1, image=image)
+                for game in games)
+            guesses = Guess.objects.bulk_create(
+                Guess(rownd_id=rownd.pk, player_id=player_id, text='bench')
+                for rownd in rounds
+                for player_id in random.sample(player_ids, GUESSES_PER_ROUND))
+            # Half the guesses get a vote, each round's from two different
+            # players since nobody votes twice in a round.
+            Vote.objects.bulk_create(
+                Vote(guess_id=guess.pk, rownd_id=guess.rownd_id,
+                     player_id=voter_id)
+                for start in range(0, len(guesses), GUESSES_PER_ROUND)
+                for guess, voter_id in zip(
+                    guesses[start:start + GUESSES_PER_ROUND:2],
+                    random.sample(player_ids, GUESSES_PER_ROUND // 2)))
+
+        return {
+            'players': list(Player.objects.order_by('?')
+                            .values_list('anonymous_user_id', flat=True)
+                            [:sample_size]),
+            'codes': list(Game.objects.filter(status=GameStatus.GUESSING_ONE)
+                          .order_by('?')
+                          .values_list('code', flat=True)[:sample_size]),
+            'answers': list(Guess.objects.exclude(player=None).order_by('?')
+                            .values_list('rownd_id', 'player_id')
+                            [:sample_size]),
+        }
+
+    def _time(self, name, lookup, keys):
+        timings = []
+        for key in keys:
+            start = time.perf_counter()
+            lookup(key)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        self.stdout.write(f"{name}: median {statistics.median(timings):.3f}ms,"
+                          f" max {max(timings):.3f}ms")
+
+    def _time_lookups(self, samples):
+        self._time("player by cookie",
+                   lambda uid: (Player.objects
+                                .filter(anonymous_user_id=uid).first()),
+                   samples['players'])
+        self._time("running game by code",
+                   lambda code: fetch_running_game(code=code),
+                   samples['codes'])
+        self._time("already guessed",
+                   lambda answer: (Guess.objects
+                                   .filter(rownd_id=answer[0],
+                                           player_id=answer[1]).exists()),
+                   samples['answers'])
+        self._time("already voted",
+                   lambda answer: (Vote.objects
+                                   .filter(player_id=answer[1],
+                                           rownd_id=answer[0])
+                                   .exists()),
+                   samples['answers'])
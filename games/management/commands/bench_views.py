@@ -0,0 +1,145 @@
+import asyncio
+import time
+from unittest.mock import patch
+
+from channels.testing import HttpCommunicator
+from django.core.asgi import get_asgi_application
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils import timezone
+from games import views
+from games.models import Game, GameStatus, Guess, Player, Round
+from games.players import PLAYER_COOKIE, sign_player
+from images.models import Image
+
+LOCAL_CACHE = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'fragments': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                  'LOCATION': 'bench-fragments'},
+}
+
+# Any 32 letters will do, the middleware only checks that the header matches
+# the cookie.
+CSRF_TOKEN = 'benchbenchbenchbenchbenchbenchbe'
+
+TIMEOUT = 120
+
+
+class Command(BaseCommand):
+
+    help = ("Send concurrent requests to the gameplay views through the ASGI "
+            "handler and report how many each of them serves per second")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000,
+                            help='requests sent to each view')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--players', type=int, default=8)
+
+    def handle(self, *args, **options):
+        players = Player.objects.bulk_create(
+            Player(nickname=f'bench {i}') for i in range(options['players']))
+        game = Game.objects.create(code='BENCH', owner=players[0],
+                                   status=GameStatus.GUESSING_ONE,
+                                   next_update=timezone.now())
+        voting = Game.objects.create(code='BENCV', owner=players[0],
+                                     status=GameStatus.VOTING_ONE,
+                                     next_update=timezone.now())
+        game.players.add(*players)
+        voting.players.add(*players)
+        image = Image.objects.create(file=ContentFile("bench",
+                                                      name="bench.png"),
+                                     caption="bench")
+
+        # Every guess and vote goes into a round the player hasn't answered
+        # yet, so each request takes the path a real answer does. Answers
+        # are only taken while their game is in the round's phase, so all of
+        # them are first rounds.
+        rounds_needed = -(-options['requests'] // len(players))
+        guess_rounds = Round.objects.bulk_create(
+            Round(game=game, image=image, order=1)
+            for i in range(rounds_needed))
+        vote_rounds = Round.objects.bulk_create(
+            Round(game=voting, image=image, order=1)
+            for i in range(rounds_needed))
+        guesses = Guess.objects.bulk_create(
+            Guess(rownd=rownd, player=player, text=f'guess {player.id}',
+                  normalized_text=f'GUESS{player.id}')
+            for rownd in vote_rounds for player in players)
+
+        try:
+            # Only the views themselves are measured: the cache is kept in
+            # process and nothing is listening for the clock's notifications.
+            with override_settings(CACHES=LOCAL_CACHE), \
+                    patch.object(views, 'notify_game_clock'):
+                asyncio.run(self._run(game, players, guess_rounds, guesses,
+                                      options))
+        finally:
+            game.delete()
+            voting.delete()
+            image.file.delete(save=False)
+            image.delete()
+            Player.objects.filter(pk__in=[p.pk for p in players]).delete()
+
+    async def _run(self, game, players, guess_rounds, guesses, options):
+        application = get_asgi_application()
+        cookies = {player.id: self._cookie(player) for player in players}
+        n = len(players)
+        requests = options['requests']
+
+        def show(i):
+            return ('GET', f'/games/play/?code={game.code}',
+                    cookies[players[i % n].id], b'')
+
+        def guess(i):
+            rownd = guess_rounds[i // n]
+            return ('POST', '/games/make_guess/', cookies[players[i % n].id],
+                    f'rownd_id={rownd.id}&guess=bench+{i}'.encode())
+
+        def vote(i):
+            # Everyone votes for the next player's guess in the round.
+            voter = i % n
+            choice = guesses[(i // n) * n + (voter + 1) % n]
+            return ('POST', '/games/vote/', cookies[players[voter].id],
+                    f'guess_id={choice.id}'.encode())
+
+        def start(i):
+            return ('POST', f'/games/start/{game.code}/',
+                    cookies[players[0].id], b'')
+
+        for name, build in (('show_game', show), ('submit_guess', guess),
+                            ('submit_vote', vote),
+                            ('start_game_clock', start)):
+            statuses, elapsed = await self._load(
+                application, [build(i) for i in range(requests)],
+                options['concurrency'])
+            failed = {status: count for status, count in statuses.items()
+                      if status != 200}
+            self.stdout.write(f"{name}: {requests / elapsed:.0f} requests/s"
+                              + (f", failed {failed}" if failed else ""))
+
+    def _cookie(self, player):
+        return (f'{PLAYER_COOKIE}={sign_player(player)}; '
+                f'csrftoken={CSRF_TOKEN}').encode()
+
+    async def _load(self, application, requests, concurrency):
+        queue = iter(requests)
+        statuses = {}
+
+        async def worker():
+            for method, path, cookie, body in queue:
+                headers = [(b'cookie', cookie), (b'host', b'localhost'),
+                           (b'x-csrftoken', CSRF_TOKEN.encode())]
+                if body:
+                    headers.append((b'content-type',
+                                    b'application/x-www-form-urlencoded'))
+                response = await HttpCommunicator(
+                    application, method, path, body=body,
+                    headers=headers).get_response(timeout=TIMEOUT)
+                statuses[response['status']] = statuses.get(
+                    response['status'], 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return statuses, time.perf_counter() - start
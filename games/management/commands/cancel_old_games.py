@@ -1,18 +1,31 @@
 import datetime as dt
 
 from django.core.management.base import BaseCommand
+from django.db.models import F
 from django.utils import timezone
+from games.codes import release_game_code
 from games.models import Game, GameStatus
 
 
 class Command(BaseCommand):
 
-    help = "Cancel games that are more than 24 hours old"
+    help = ("Cancel games that are more than 24 hours old, and close finished "
+            "ones so their codes can be handed out again")
 
     def handle(self, *args, **options):
+        day_ago = timezone.now() - dt.timedelta(days=1)
         old_games = Game.objects.filter(status=GameStatus.STARTING,
-                                        created__lte=timezone.now() - dt.timedelta(days=1))
+                                        created__lte=day_ago)
         for game in old_games:
             game.scoring_results['status'] = f"Cancelled by cron: {timezone.now().isoformat()}"
             game.status = GameStatus.ABANDONED
             game.save()
+            release_game_code(game.code)
+
+        finished_games = Game.objects.filter(status=GameStatus.COMPLETE,
+                                             closed=False,
+                                             created__lte=day_ago)
+        codes = set(finished_games.values_list('code', flat=True))
+        finished_games.update(closed=True, version=F('version') + 1)
+        for code in codes:
+            release_game_code(code)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from games.codes import CODE_LENGTH, fill_code_pool
+from games.models import Game
+
+
+class Command(BaseCommand):
+
+    help = ("Fill the pool new game codes are taken from. Run it once before "
+            "the first deploy that uses the pool, or with a new --length to "
+            "switch to longer codes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--length', type=int, default=CODE_LENGTH)
+
+    def handle(self, *args, **options):
+        max_length = Game._meta.get_field('code').max_length
+        if not 0 < options['length'] <= max_length:
+            raise CommandError(f"--length must be between 1 and {max_length}")
+
+        count = fill_code_pool(options['length'])
+        self.stdout.write(f"{count} codes are free")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from games.clock import GameClock
+
+
+class Command(BaseCommand):
+
+    help = "Run the clock that advances every running game"
+
+    def handle(self, *args, **options):
+        GameClock().run()
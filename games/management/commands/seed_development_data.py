@@ -1,7 +1,7 @@
 import uuid
 
 from django.core.management.base import BaseCommand
-from games.engine import compute_score
+from games.engine import compute_score, create_rounds
 from games.models import Game, GameStatus, Player
 from images.models import Image
 
@@ -14,10 +14,9 @@ class Command(BaseCommand):
         for player in players:
             game.players.add(player)
 
-        for i in range(5):
-            image = Image.objects.get(pk=i + 1)
-            rownd = game.rounds.create(order=i + 1, image=image)
-            rownd.guesses.create(player=None, text=image.caption)
+        create_rounds(game, list(Image.objects
+                                 .order_by('pk')
+                                 .values_list('pk', flat=True)[:5]))
 
         player_list = {p.id: p.nickname for p in game.players.all()}
         game.scoring_results = {
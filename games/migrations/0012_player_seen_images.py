@@ -0,0 +1,42 @@
+# Generated by Django 4.1.2 on 2026-10-17 01:29
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def record_seen_images(apps, _):
+    Game = apps.get_model('games', 'Game')
+    Player = apps.get_model('games', 'Player')
+    SeenImage = Player.seen_images.through
+
+    seen = []
+    games = (Game.objects.filter(status='CM')
+             .prefetch_related('players', 'rounds')
+             .iterator(chunk_size=BATCH_SIZE))
+    for game in games:
+        seen += [SeenImage(player_id=player.id, image_id=rownd.image_id)
+                 for player in game.players.all()
+                 for rownd in game.rounds.all()]
+        if len(seen) >= BATCH_SIZE:
+            SeenImage.objects.bulk_create(seen, ignore_conflicts=True)
+            seen = []
+
+    SeenImage.objects.bulk_create(seen, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0002_auto_20221129_2301'),
+        ('games', '0011_game_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='seen_images',
+            field=models.ManyToManyField(blank=True, related_name='seen_by', to='images.image'),
+        ),
+        migrations.RunPython(record_seen_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.2 on 2026-10-17 01:44
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0012_player_seen_images'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='anonymous_user_id',
+            field=models.UUIDField(db_index=True, default=uuid.uuid4),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('status__in', ['CM', 'AB']), _negated=True), fields=['code'], name='running_game_code'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['code', '-created'], name='game_code_created'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.1.2 on 2026-10-17 01:44
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_answers(apps, _):
+    # Two clicks racing each other could get past the checks in the views,
+    # keep the first answer so the constraints can be added.
+    Guess = apps.get_model('games', 'Guess')
+    Vote = apps.get_model('games', 'Vote')
+
+    for model, fields in ((Guess, ('rownd', 'player')),
+                          (Vote, ('player', 'guess'))):
+        duplicates = (model.objects
+                      .exclude(**{f'{fields[1]}': None})
+                      .values(*fields)
+                      .annotate(first=Min('pk'), count=Count('pk'))
+                      .filter(count__gt=1))
+        for duplicate in duplicates:
+            (model.objects
+             .filter(**{field: duplicate[field] for field in fields})
+             .exclude(pk=duplicate['first'])
+             .delete())
+
+
+class Migration(migrations.Migration):
+
+    # Kept apart from the constraints that need it: PostgreSQL won't alter a
+    # table with deletes still waiting on deferred foreign key checks.
+    dependencies = [
+        ('games', '0013_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_answers,
+                             migrations.RunPython.noop),
+    ]
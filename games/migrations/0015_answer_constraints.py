@@ -0,0 +1,21 @@
+# Generated by Django 4.1.2 on 2026-10-17 01:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0014_remove_duplicate_answers'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='guess',
+            constraint=models.UniqueConstraint(fields=('rownd', 'player'), name='one_guess_per_player'),
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('player', 'guess'), name='one_vote_per_guess'),
+        ),
+    ]
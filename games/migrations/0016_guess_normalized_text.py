@@ -0,0 +1,22 @@
+# Generated by Django 4.1.2 on 2026-10-17 01:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0015_answer_constraints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='guess',
+            name='normalized_text',
+            field=models.CharField(default='', editable=False, max_length=50),
+        ),
+        migrations.AddConstraint(
+            model_name='guess',
+            constraint=models.UniqueConstraint(condition=models.Q(('normalized_text', ''), _negated=True), fields=('rownd', 'normalized_text'), name='unique_guess_per_round'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.2 on 2026-10-17 02:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0016_guess_normalized_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='rownd',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='votes', to='games.round'),
+        ),
+    ]
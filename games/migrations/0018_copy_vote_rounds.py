@@ -0,0 +1,40 @@
+# Generated by Django 4.1.2 on 2026-10-17 02:05
+
+from django.db import migrations
+from django.db.models import Count, Min, OuterRef, Subquery
+
+
+def copy_rounds_from_guesses(apps, _):
+    Guess = apps.get_model('games', 'Guess')
+    Vote = apps.get_model('games', 'Vote')
+
+    Vote.objects.update(rownd_id=Subquery(
+        Guess.objects.filter(pk=OuterRef('guess_id')).values('rownd_id')[:1]))
+
+    # Keep each player's first vote in a round, anything after it got past
+    # the check in submit_vote by racing it.
+    duplicates = (Vote.objects
+                  .values('player_id', 'rownd_id')
+                  .annotate(first=Min('pk'), count=Count('pk'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        (Vote.objects
+         .filter(player_id=duplicate['player_id'],
+                 rownd_id=duplicate['rownd_id'])
+         .exclude(pk=duplicate['first'])
+         .delete())
+
+
+class Migration(migrations.Migration):
+
+    # The column is added before and made required after this, each in its
+    # own migration: PostgreSQL won't alter a table with deletes still
+    # waiting on deferred foreign key checks.
+    dependencies = [
+        ('games', '0017_vote_rownd'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_rounds_from_guesses,
+                             migrations.RunPython.noop),
+    ]
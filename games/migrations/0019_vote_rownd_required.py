@@ -0,0 +1,27 @@
+# Generated by Django 4.1.2 on 2026-10-17 02:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0018_copy_vote_rounds'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vote',
+            name='rownd',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='votes', to='games.round'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='vote',
+            name='one_vote_per_guess',
+        ),
+        migrations.AddConstraint(
+            model_name='vote',
+            constraint=models.UniqueConstraint(fields=('player', 'rownd'), name='one_vote_per_round'),
+        ),
+    ]
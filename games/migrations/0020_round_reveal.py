@@ -0,0 +1,18 @@
+# Generated by Django 4.1.2 on 2026-10-17 02:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0019_vote_rownd_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='round',
+            name='reveal',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
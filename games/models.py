@@ -6,10 +6,12 @@ from django.utils.translation import gettext_lazy as _
 
 class Player(models.Model):
     nickname = models.CharField(default="", max_length=20)
-    anonymous_user_id = models.UUIDField(default=uuid.uuid4)
+    anonymous_user_id = models.UUIDField(default=uuid.uuid4, db_index=True)
     user = models.ForeignKey(on_delete=models.SET_NULL,
                              null=True, blank=True, to='auth.User')
     created = models.DateTimeField(auto_now_add=True)
+    seen_images = models.ManyToManyField(to='images.Image', blank=True,
+                                         related_name='seen_by')
 
     def __str__(self):
         return f"{self.id}: {self.nickname}"
@@ -50,6 +52,18 @@ class Game(models.Model):
     reveal_step = models.IntegerField(default=1)
     scoring_results = models.JSONField(blank=True, null=True, default=dict)
     closed = models.BooleanField(default=False)
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Codes are handed out again once a game is over, running games
+            # are the ones looked up on every request.
+            models.Index(fields=['code'], name='running_game_code',
+                         condition=~models.Q(status__in=[
+                             GameStatus.COMPLETE, GameStatus.ABANDONED])),
+            models.Index(fields=['code', '-created'],
+                         name='game_code_created'),
+        ]
 
     def __str__(self):
         return self.code
@@ -60,6 +74,13 @@ class Round(models.Model):
                              related_name='rounds')
     order = models.IntegerField(default=1)
     image = models.ForeignKey(to='images.Image', on_delete=models.CASCADE)
+    # What the reveal shows at each step, written once voting closes.
+    reveal = models.JSONField(default=list, blank=True)
+
+
+def normalize_guess(text):
+    """Reduce a guess to what counts when comparing it to the others."""
+    return ''.join(text.upper().split())
 
 
 class Guess(models.Model):
@@ -68,9 +89,41 @@ class Guess(models.Model):
     player = models.ForeignKey(to='games.Player', on_delete=models.CASCADE,
                                null=True, related_name='guesses')
     text = models.CharField(default="", max_length=50)
+    normalized_text = models.CharField(default="", max_length=50,
+                                       editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['rownd', 'player'],
+                                    name='one_guess_per_player'),
+            # Rows written before the column existed stay empty until
+            # they're backfilled.
+            models.UniqueConstraint(fields=['rownd', 'normalized_text'],
+                                    name='unique_guess_per_round',
+                                    condition=~models.Q(normalized_text='')),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.normalized_text = normalize_guess(self.text)
+        super().save(*args, **kwargs)
 
 
 class Vote(models.Model):
     player = models.ForeignKey(to='games.Player', on_delete=models.CASCADE,)
     guess = models.ForeignKey(to='games.Guess', on_delete=models.CASCADE,
                               related_name='votes')
+    # Copied from the guess so the database can hold players to one vote
+    # per round.
+    rownd = models.ForeignKey(to='games.Round', on_delete=models.CASCADE,
+                              related_name='votes')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['player', 'rownd'],
+                                    name='one_vote_per_round'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.rownd_id is None:
+            self.rownd_id = self.guess.rownd_id
+        super().save(*args, **kwargs)
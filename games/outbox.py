@@ -0,0 +1,144 @@
+import asyncio
+import atexit
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+
+from channels.layers import get_channel_layer
+
+# Messages waiting to go out beyond this many are dropped, oldest first, so a
+# channel layer that is down can't take the process's memory with it.
+OUTBOX_SIZE = 10000
+
+# Most messages taken off the queue and sent in one go.
+BATCH_SIZE = 100
+
+# A group send that fails is tried this many more times, waiting RETRY_WAIT
+# seconds longer each time, before the message is given up on.
+RETRIES = 3
+RETRY_WAIT = 0.1
+
+# Totals for this process. Messages queued minus sent, dropped and failed is
+# what is still waiting, send_ms adds up how long the ones that went out took.
+outbox_stats = Counter()
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """Sends channel layer messages from a background thread.
+
+    Callers only put a message on a bounded queue, so a slow or unreachable
+    channel layer never holds up a response. A single thread sends everything
+    in the order it was queued, on an event loop of its own that keeps the
+    channel layer's connections open between batches.
+    """
+
+    def __init__(self, size=OUTBOX_SIZE):
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def put(self, groups, data):
+        self._start()
+        outbox_stats['queued'] += 1
+        while True:
+            try:
+                self.queue.put_nowait((groups, data))
+                return
+            except queue.Full:
+                self._drop_oldest()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def flush(self, timeout=None):
+        """Wait for everything queued so far to be sent or given up on.
+
+        Returns False if the timeout ran out first.
+        """
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(
+                lambda: not self.queue.unfinished_tasks, timeout)
+
+    def _drop_oldest(self):
+        try:
+            self.queue.get_nowait()
+        except queue.Empty:
+            return
+
+        self.queue.task_done()
+        outbox_stats['dropped'] += 1
+
+    def _start(self):
+        if self.thread and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if not (self.thread and self.thread.is_alive()):
+                self.thread = threading.Thread(target=self._run,
+                                               name='outbox', daemon=True)
+                self.thread.start()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        while True:
+            batch = self._next_batch()
+            try:
+                loop.run_until_complete(self._send(batch))
+            except Exception:
+                logger.exception("Sending %s channel messages failed",
+                                 len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _send(self, batch):
+        channel_layer = get_channel_layer()
+        for groups, data in batch:
+            start = time.perf_counter()
+            sent = True
+            for group in groups:
+                sent = await self._group_send(channel_layer, group,
+                                              data) and sent
+
+            if sent:
+                send_ms = (time.perf_counter() - start) * 1000
+                outbox_stats['sent'] += 1
+                outbox_stats['send_ms'] += send_ms
+                outbox_stats['max_send_ms'] = max(
+                    outbox_stats['max_send_ms'], send_ms)
+            else:
+                outbox_stats['failed'] += 1
+
+    async def _group_send(self, channel_layer, group, data):
+        for attempt in range(RETRIES + 1):
+            try:
+                await channel_layer.group_send(group, data)
+                return True
+            except Exception:
+                if attempt == RETRIES:
+                    logger.exception("Gave up sending %s to %s",
+                                     data.get('type'), group)
+                    return False
+
+                outbox_stats['retried'] += 1
+                await asyncio.sleep(RETRY_WAIT * (attempt + 1))
+
+
+outbox = Outbox()
+
+# Whatever a short lived process queued still gets a chance to go out.
+atexit.register(outbox.flush, 5)
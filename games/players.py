@@ -0,0 +1,51 @@
+import datetime as dt
+import uuid
+
+from django.core import signing
+from django.utils import timezone
+
+from .models import Player
+
+PLAYER_COOKIE = 'player'
+PLAYER_COOKIE_SALT = 'games.players'
+PLAYER_COOKIE_AGE = dt.timedelta(days=365)
+
+
+def sign_player(player):
+    return signing.dumps([player.id, str(player.anonymous_user_id),
+                          player.nickname, player.user_id],
+                         salt=PLAYER_COOKIE_SALT)
+
+
+def set_player_cookie(response, player):
+    """Remember the player in a cookie the server can trust without a query.
+
+    The plain uuid is still set for clients that only have that, the signed
+    cookie is rewritten whenever the player's nickname changes.
+    """
+    expires = timezone.now() + PLAYER_COOKIE_AGE
+    response.set_cookie('player_id', str(player.anonymous_user_id),
+                        expires=expires)
+    response.set_cookie(PLAYER_COOKIE, sign_player(player), expires=expires,
+                        httponly=True, samesite='Lax')
+
+
+def player_from_cookie(cookies):
+    """The player a signed cookie was issued to, without touching the database.
+
+    Only the fields the cookie carries are loaded, anything else is fetched
+    the first time it's used. Returns None when there's no cookie or it
+    doesn't verify.
+    """
+    try:
+        id, anonymous_user_id, nickname, user_id = signing.loads(
+            cookies.get(PLAYER_COOKIE, ''), salt=PLAYER_COOKIE_SALT,
+            max_age=PLAYER_COOKIE_AGE)
+        anonymous_user_id = uuid.UUID(anonymous_user_id)
+    except (signing.BadSignature, ValueError, TypeError):
+        return None
+
+    # from_db takes the values in the order the model declares its fields.
+    return Player.from_db('default',
+                          ['id', 'nickname', 'anonymous_user_id', 'user_id'],
+                          [id, nickname, anonymous_user_id, user_id])
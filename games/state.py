@@ -0,0 +1,104 @@
+import datetime as dt
+
+from django.core.cache import cache
+
+from .utils import epoch_ms, status
+
+# Long enough to outlive any game that is still being played, anything left
+# behind by a crashed game just expires.
+STATE_TIMEOUT = 60 * 60 * 3
+
+# A tick takes milliseconds, a lease only lasts this long in case the clock
+# holding it dies before releasing it.
+LEASE_TIME = 30
+
+
+def _state_key(game_id):
+    return f"game-state-{game_id}"
+
+
+def _answers_key(game_id, phase):
+    return f"game-{game_id}-{phase}-answers"
+
+
+def _answered_key(game_id, phase, player_id):
+    return f"game-{game_id}-{phase}-answered-{player_id}"
+
+
+def _lease_key(game_id):
+    return f"game-lease-{game_id}"
+
+
+def acquire_lease(game_id):
+    return cache.add(_lease_key(game_id), True, LEASE_TIME)
+
+
+def release_lease(game_id):
+    cache.delete(_lease_key(game_id))
+
+
+def record_answer(game_id, phase, player_id):
+    """Count a guess or vote towards the phase it was made in.
+
+    Each player only counts once per phase. If the counter has been lost the
+    engine falls back to counting rows, so a missing key is not an error.
+    """
+    if cache.add(_answered_key(game_id, phase, player_id), True,
+                 STATE_TIMEOUT):
+        try:
+            cache.incr(_answers_key(game_id, phase))
+        except ValueError:
+            pass
+
+
+class GameState:
+    """The part of a running game the clock needs on every tick.
+
+    The engine writes it to the cache whenever the game's row changes, so
+    countdown ticks and answer checks can run without touching the database
+    until the game is actually ready to move to its next phase.
+    """
+
+    def __init__(self, id, code, status, next_update, reveal_step,
+                 player_count):
+        self.id = id
+        self.code = code
+        self.status = status
+        self.next_update = next_update
+        self.reveal_step = reveal_step
+        self.player_count = player_count
+
+    @classmethod
+    def from_game(cls, game):
+        players = (game.scoring_results or {}).get('players', {})
+        return cls(game.id, game.code, game.status, game.next_update,
+                   game.reveal_step, len(players))
+
+    @classmethod
+    def _from_cache(cls, data):
+        next_update = data['next_update'] and dt.datetime.fromtimestamp(
+            data['next_update'] / 1000, tz=dt.timezone.utc)
+        return cls(**{**data, 'next_update': next_update})
+
+    @classmethod
+    def get_many(cls, game_ids):
+        found = cache.get_many([_state_key(id) for id in game_ids])
+        return {data['id']: cls._from_cache(data) for data in found.values()}
+
+    @classmethod
+    def delete(cls, game_id):
+        cache.delete(_state_key(game_id))
+
+    def save(self):
+        cache.set(_state_key(self.id),
+                  {**vars(self), 'next_update': epoch_ms(self.next_update)},
+                  STATE_TIMEOUT)
+        cache.add(_answers_key(self.id, self.status), 0, STATE_TIMEOUT)
+
+    def counting_down(self, now):
+        return (status(self) in ('guessing', 'voting') and
+                self.next_update > now)
+
+    def waiting_on_players(self):
+        answers = cache.get(_answers_key(self.id, self.status))
+        return answers is not None and answers < self.player_count
@@ -0,0 +1,201 @@
+import datetime as dt
+import json
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import TestCase
+from django.utils import timezone
+from images.models import Image
+
+from games.clock import IDLE_WAIT, GameClock
+from games.engine import StaleGameError
+from games.models import Game, GameStatus, Player, Round
+from games.state import GameState, acquire_lease, record_answer
+from games.utils import game_content_event
+
+
+class GameClockTestCase(TestCase):
+    def setUp(self):
+        self.clock = GameClock()
+        self.now = timezone.now()
+
+    def test_due_returns_games_in_deadline_order(self):
+        self.clock.schedule(1, self.now + dt.timedelta(seconds=2))
+        self.clock.schedule(2, self.now - dt.timedelta(seconds=1))
+        self.clock.schedule(3, self.now)
+
+        self.assertEqual(self.clock.due(self.now), [2, 3])
+        self.assertEqual(self.clock.due(self.now + dt.timedelta(seconds=3)),
+                         [1])
+
+    def test_rescheduling_replaces_old_deadline(self):
+        self.clock.schedule(1, self.now)
+        self.clock.schedule(1, self.now + dt.timedelta(seconds=5))
+
+        self.assertEqual(self.clock.due(self.now), [])
+        self.assertEqual(self.clock.seconds_until_next(self.now), 5)
+
+    def test_idle_clock_waits_for_messages(self):
+        self.assertEqual(self.clock.seconds_until_next(self.now), IDLE_WAIT)
+
+    def test_overdue_game_does_not_wait(self):
+        self.clock.schedule(1, self.now - dt.timedelta(seconds=5))
+
+        self.assertEqual(self.clock.seconds_until_next(self.now), 0)
+
+    def test_receive_schedules_game(self):
+        when = self.now + dt.timedelta(seconds=1)
+        self.clock.receive(json.dumps({'game_id': 7, 'at': when.timestamp()}))
+
+        self.assertEqual(self.clock.due(when), [7])
+
+
+class GameClockAdvanceTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = Player.objects.create(nickname='owner')
+        cls.game = Game.objects.create(code='ABCD',
+                                       status=GameStatus.GUESSING_ONE,
+                                       next_update=timezone.now(),
+                                       owner=owner)
+        cls.game.players.add(owner)
+        image = Image.objects.create(file=ContentFile("not a real image",
+                                                      name="image"),
+                                     caption="image title")
+        Round.objects.create(game=cls.game, order=1, image=image)
+        Game.objects.create(code='EFGH', status=GameStatus.COMPLETE,
+                            owner=owner)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_load_running_games(self):
+        clock = GameClock()
+        clock.load_running_games()
+
+        self.assertEqual(clock.scheduled, {self.game.id:
+                                           self.game.next_update})
+
+    def test_advance_ticks_and_reschedules(self):
+        clock = GameClock()
+
+        with patch('games.engine.send_channel_message') as send_message:
+            clock.advance([self.game.id])
+
+        self.game.refresh_from_db()
+        send_message.assert_any_call(self.game.code,
+                                     game_content_event(self.game))
+        self.assertEqual(self.game.status, GameStatus.VOTING_ONE)
+        self.assertIn(self.game.id, clock.scheduled)
+
+    def test_counting_down_games_tick_from_cache(self):
+        self.game.next_update = timezone.now() + dt.timedelta(seconds=30)
+        GameState.from_game(self.game).save()
+        clock = GameClock()
+
+        with patch('games.engine.send_channel_message') as send_message:
+            with self.assertNumQueries(0):
+                clock.advance([self.game.id])
+            send_message.assert_called_once()
+
+        self.assertIn(self.game.id, clock.scheduled)
+
+    def test_check_answers_skips_games_waiting_on_players(self):
+        self.game.scoring_results = {'players': {1: 'owner', 2: 'other'}}
+        GameState.from_game(self.game).save()
+        record_answer(self.game.id, self.game.status, 1)
+        clock = GameClock()
+
+        with patch('games.clock.answer_submitted') as answer_submitted:
+            clock.check_answers([self.game.id])
+            answer_submitted.assert_not_called()
+
+        record_answer(self.game.id, self.game.status, 2)
+        with patch('games.clock.answer_submitted') as answer_submitted:
+            answer_submitted.__name__ = 'answer_submitted'
+            clock.check_answers([self.game.id])
+            answer_submitted.assert_called_once()
+
+    def test_leased_games_are_left_to_their_clock(self):
+        acquire_lease(self.game.id)
+        clock = GameClock()
+
+        with patch('games.engine.send_channel_message') as send_message:
+            clock.advance([self.game.id])
+            send_message.assert_not_called()
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.status, GameStatus.GUESSING_ONE)
+        self.assertIn(self.game.id, clock.scheduled)
+
+    def test_stale_game_is_retried(self):
+        clock = GameClock()
+
+        with patch('games.clock.tick',
+                   side_effect=StaleGameError(self.game.id)) as tick:
+            tick.__name__ = 'tick'
+            clock.advance([self.game.id])
+
+        self.assertEqual(clock.due(timezone.now()), [self.game.id])
+
+    def test_failed_tick_backs_off(self):
+        clock = GameClock()
+
+        with patch('games.clock.tick', side_effect=ValueError) as tick:
+            tick.__name__ = 'tick'
+            clock.advance([self.game.id])
+            first = clock.scheduled[self.game.id]
+            retried = timezone.now()
+            clock.advance(clock.due(first))
+            second = clock.scheduled[self.game.id]
+
+        self.assertEqual(clock.failures[self.game.id], 2)
+        self.assertGreater(second - retried, dt.timedelta(seconds=1.5))
+
+        with patch('games.engine.send_channel_message'):
+            clock.advance(clock.due(second))
+
+        self.assertNotIn(self.game.id, clock.failures)
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.status, GameStatus.VOTING_ONE)
+
+    def test_failed_load_is_retried(self):
+        clock = GameClock()
+
+        with patch.object(clock, '_load_for_tick', side_effect=ValueError):
+            clock.advance([self.game.id])
+
+        self.assertIn(self.game.id, clock.scheduled)
+        self.assertEqual(clock.failures[self.game.id], 1)
+
+    def test_failed_answer_check_is_checked_again(self):
+        clock = GameClock()
+
+        with patch('games.clock.answer_submitted',
+                   side_effect=ValueError) as answer_submitted:
+            answer_submitted.__name__ = 'answer_submitted'
+            clock.check_answers([self.game.id])
+
+        self.assertEqual(clock.recheck, {self.game.id})
+
+        with patch('games.clock.answer_submitted',
+                   return_value=None) as answer_submitted, \
+                patch('games.clock.tick', return_value=None) as tick:
+            clock.advance(clock.due(clock.scheduled[self.game.id]))
+
+        answer_submitted.assert_called_once()
+        tick.assert_called_once()
+        self.assertEqual(clock.recheck, set())
+
+    def test_run_carries_on_when_the_queue_fails(self):
+        clock = GameClock()
+
+        with patch.object(clock, 'load_running_games'), \
+                patch.object(clock, 'wait_for_messages',
+                             side_effect=[ConnectionError, KeyboardInterrupt]), \
+                patch('games.clock.time.sleep') as sleep:
+            with self.assertRaises(KeyboardInterrupt):
+                clock.run()
+
+        sleep.assert_called_once()
@@ -0,0 +1,91 @@
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from games.codes import (CODE_POOL, POOL_LENGTH, allocate_game_code,
+                         fill_code_pool, release_game_code)
+from games.models import Game, GameStatus, Player
+
+
+class GameCodePoolTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = Player.objects.create(nickname='owner')
+        Game.objects.create(code='AA', owner=owner)
+        Game.objects.create(code='AB', owner=owner,
+                            status=GameStatus.COMPLETE)
+        Game.objects.create(code='AC', owner=owner,
+                            status=GameStatus.COMPLETE, closed=True)
+        Game.objects.create(code='AD', owner=owner,
+                            status=GameStatus.ABANDONED)
+
+    def setUp(self):
+        patcher = patch('games.codes.redis_client')
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def test_allocate_takes_code_from_pool(self):
+        self.redis.spop.return_value = b'WXYZ'
+
+        self.assertEqual(allocate_game_code(), 'WXYZ')
+        self.redis.spop.assert_called_once_with(CODE_POOL)
+
+    def test_allocate_falls_back_when_pool_is_empty(self):
+        self.redis.spop.return_value = None
+        self.redis.get.return_value = None
+
+        with patch('games.codes._random_code',
+                   side_effect=['AA', 'AB', 'AC']) as random_code:
+            self.assertEqual(allocate_game_code(), 'AC')
+
+        random_code.assert_called_with(4)
+
+    def test_fallback_uses_the_pool_code_length(self):
+        self.redis.spop.return_value = None
+        self.redis.get.return_value = b'5'
+
+        self.assertEqual(len(allocate_game_code()), 5)
+        self.redis.get.assert_called_once_with(POOL_LENGTH)
+
+    def test_release_skips_codes_still_in_use(self):
+        release_game_code('AA')
+        release_game_code('AB')
+        self.redis.sadd.assert_not_called()
+
+        release_game_code('AC')
+        release_game_code('AD')
+        self.assertEqual(self.redis.sadd.call_count, 2)
+
+    def test_fill_leaves_out_held_codes(self):
+        self.redis.srem.return_value = 0
+        self.assertEqual(fill_code_pool(2), 26 * 26 - 2)
+
+        added = {code for call in self.redis.sadd.call_args_list
+                 for code in call.args[1:]}
+        self.assertNotIn('AA', added)
+        self.assertNotIn('AB', added)
+        self.assertIn('AC', added)
+        self.redis.rename.assert_called_once_with(f"{CODE_POOL}:filling",
+                                                  CODE_POOL)
+        self.redis.set.assert_called_once_with(POOL_LENGTH, 2)
+
+    def test_fill_takes_back_codes_handed_out_while_filling(self):
+        def game_created(*args):
+            if not Game.objects.filter(code='ZZ').exists():
+                Game.objects.create(code='ZZ',
+                                    owner=Player.objects.first())
+
+        self.redis.sadd.side_effect = game_created
+        self.redis.srem.return_value = 1
+
+        self.assertEqual(fill_code_pool(2), 26 * 26 - 3)
+        removed = {code for call in self.redis.srem.call_args_list
+                   for code in call.args[1:]}
+        self.assertIn('ZZ', removed)
+
+    def test_fill_command_checks_length(self):
+        with self.assertRaises(CommandError):
+            call_command('fill_game_codes', length=6)
+
+        self.redis.rename.assert_not_called()
@@ -0,0 +1,130 @@
+from unittest.mock import patch
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.sessions import CookieMiddleware
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from games.consumers import RunningGameConsumer, refresh_stats
+from games.models import Game, GameStatus, Player
+from games.players import PLAYER_COOKIE, sign_player
+from games.routing import websocket_url_patterns
+from games.utils import game_content_event, player_group
+
+application = CookieMiddleware(URLRouter(websocket_url_patterns))
+
+
+@override_settings(CHANNEL_LAYERS={
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RunningGameConsumerTestCase(TransactionTestCase):
+    # The consumer reads the database from another thread, so the game has
+    # to be committed for it to be found.
+
+    def setUp(self):
+        self.owner = Player.objects.create(nickname='owner')
+        self.player = Player.objects.create(nickname='player')
+        self.game = Game.objects.create(code='ABCD', owner=self.owner,
+                                        status=GameStatus.GUESSING_ONE,
+                                        next_update=timezone.now())
+        self.game.players.add(self.owner, self.player)
+
+    def _socket(self, player, code='ABCD'):
+        cookie = f'player_id={player.anonymous_user_id}'.encode()
+        return WebsocketCommunicator(application, f"/ws/game/{code}/",
+                                     headers=[(b'cookie', cookie)])
+
+    async def test_unknown_game_is_refused(self):
+        socket = self._socket(self.player, code='WXYZ')
+        connected, _ = await socket.connect()
+
+        self.assertFalse(connected)
+
+    async def test_signed_cookie_connects_without_player_lookup(self):
+        cookie = f'{PLAYER_COOKIE}={sign_player(self.player)}'.encode()
+        socket = WebsocketCommunicator(application, "/ws/game/ABCD/",
+                                       headers=[(b'cookie', cookie)])
+
+        with patch('games.consumers.Player') as player_model:
+            connected, _ = await socket.connect()
+            player_model.objects.filter.assert_not_called()
+
+        self.assertTrue(connected)
+        await socket.disconnect()
+
+    async def test_ping(self):
+        socket = self._socket(self.player)
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+
+        await socket.send_json_to({'message': 'ping'})
+        self.assertEqual(await socket.receive_json_from(),
+                         {'message': 'pong'})
+
+        await socket.disconnect()
+
+    async def test_refresh_game_content(self):
+        socket = self._socket(self.player)
+        await socket.connect()
+
+        await get_channel_layer().group_send(
+            'ABCD', {'type': 'refresh_game_content'})
+        html = await socket.receive_from()
+
+        self.assertIn('id="game_content"', html)
+        await socket.disconnect()
+
+    async def test_refresh_renders_from_event_context(self):
+        event = await database_sync_to_async(game_content_event)(self.game)
+        socket = self._socket(self.player)
+        await socket.connect()
+
+        with patch.object(RunningGameConsumer,
+                          '_render_game_content') as render:
+            await get_channel_layer().group_send('ABCD', event)
+            html = await socket.receive_from()
+            render.assert_not_called()
+
+        self.assertIn('guess-display', html)
+        await socket.disconnect()
+
+    async def test_refresh_bursts_are_sent_once(self):
+        socket = self._socket(self.player)
+        await socket.connect()
+        received = refresh_stats['received']
+        sent = refresh_stats['sent']
+
+        for _ in range(3):
+            await get_channel_layer().group_send(
+                'ABCD', {'type': 'refresh_game_content'})
+        await get_channel_layer().group_send(
+            'ABCD', {'type': 'countdown_update', 'deadline': 1})
+
+        self.assertIn('id="game_content"', await socket.receive_from())
+        self.assertTrue(await socket.receive_nothing())
+        self.assertEqual(refresh_stats['received'] - received, 3)
+        self.assertEqual(refresh_stats['sent'] - sent, 1)
+
+        await socket.disconnect()
+
+    async def test_only_owner_gets_owner_messages(self):
+        owner_socket = self._socket(self.owner)
+        await owner_socket.connect()
+        player_socket = self._socket(self.player)
+        await player_socket.connect()
+
+        await get_channel_layer().group_send(
+            'ABCD', {'type': 'player_added', 'player': 'newbie', 'count': 3})
+        await get_channel_layer().group_send(
+            player_group('ABCD', self.owner.id),
+            {'type': 'owner_message', 'html': '<div id="owner_message"></div>'})
+
+        self.assertIn('<li>newbie</li>', await owner_socket.receive_from())
+        self.assertIn('owner_message', await owner_socket.receive_from())
+        self.assertIn('<li>newbie</li>', await player_socket.receive_from())
+        self.assertTrue(await player_socket.receive_nothing())
+
+        await owner_socket.disconnect()
+        await player_socket.disconnect()
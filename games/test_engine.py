@@ -1,15 +1,21 @@
 import datetime as dt
 import os
+from unittest.mock import patch
 
 from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from images.models import Image
 
-from games.engine import (compute_score, guessing_update, revealing_update,
-                          start_game, voting_update)
-from games.models import Game, GameStatus, Player, Round
+from games.engine import (SAMPLE_ATTEMPTS, StaleGameError, _sample_images,
+                          answer_submitted, compute_score, guessing_update,
+                          revealing_update, start_game, tick, voting_update)
+from games.models import Game, GameStatus, Guess, Player, Round
+from games.utils import (bump_version, game_content_event, reveal_script,
+                         shared_game_context)
 
 
 class EngineTestCase(TestCase):
@@ -26,6 +32,9 @@ class EngineTestCase(TestCase):
             Image.objects.create(file=content_file,
                                  caption=f"image {i} title")
 
+    def setUp(self):
+        self.game.refresh_from_db()
+
     @classmethod
     def tearDownClass(cls):
         super(EngineTestCase, cls).tearDownClass()
@@ -52,6 +61,53 @@ class EngineTestCase(TestCase):
 
         self.assertEqual(len(set(unique_images)), 5)
 
+        captions = Guess.objects.filter(rownd__game=self.game, player=None)
+        for caption in captions:
+            self.assertEqual(caption.normalized_text,
+                             caption.text.upper().replace(' ', ''))
+
+    def test_start_game_query_budget(self):
+        # Nobody has seen an image, so one sample picks every round's: the
+        # id bounds, a query per batch of random ids and, if those come up
+        # short, one to shuffle the rest. However many rounds there are,
+        # the rest of the setup is the images, the rounds, the captions, the
+        # players, the game and the savepoint around it all.
+        with CaptureQueriesContext(connection) as queries:
+            start_game(self.game, continue_timer=False)
+
+        self.assertLessEqual(len(queries), 1 + SAMPLE_ATTEMPTS + 1 + 7)
+
+    def test_start_game_avoids_images_players_have_seen(self):
+        seen = Image.objects.first()
+        self.game.owner.seen_images.add(seen)
+
+        start_game(self.game, continue_timer=False)
+
+        image_ids = self.game.rounds.values_list('image_id', flat=True)
+        self.assertEqual(len(set(image_ids)), 5)
+        self.assertNotIn(seen.id, image_ids)
+
+    def test_start_game_reuses_seen_images_when_needed(self):
+        self.game.owner.seen_images.add(*Image.objects.all()[:3])
+
+        start_game(self.game, continue_timer=False)
+
+        image_ids = self.game.rounds.values_list('image_id', flat=True)
+        self.assertEqual(len(set(image_ids)), 5)
+
+    def test_sampled_images_are_equally_likely(self):
+        # The two ends of the library, with everything between them left
+        # out, so most ids drawn miss.
+        images = Image.objects.order_by('pk')
+        first, last = images.first().pk, images.last().pk
+        candidates = Image.objects.filter(pk__in=[first, last])
+
+        picks = [_sample_images(candidates, 1)[0] for _ in range(200)]
+
+        self.assertEqual(set(picks), {first, last})
+        self.assertGreater(picks.count(first), 60)
+        self.assertGreater(picks.count(last), 60)
+
     def test_start_game_adds_nicknames_to_scoring_results(self):
         start_game(self.game, continue_timer=False)
 
@@ -104,6 +160,45 @@ class EngineTestCase(TestCase):
 
         self.assertTrue(result)
         self.assertEqual(self.game.status, GameStatus.REVEAL_THREE)
+        r.refresh_from_db()
+        self.assertEqual(r.reveal, [["Real Guess", None, ["Owner"]]])
+
+    def test_vote_landing_during_transition_makes_it_stale(self):
+        self.game.status = GameStatus.VOTING_THREE
+        self.game.save()
+        r = self.game.rounds.create(order=3, image=Image.objects.first())
+        g = r.guesses.create(text="Real Guess")
+
+        def late_vote(rownd):
+            # Goes in the way submit_vote saves one, after the script was
+            # read but before the game moved on.
+            script = reveal_script(rownd)
+            self.assertTrue(bump_version(self.game.id, self.game.status))
+            g.votes.create(player=self.game.owner, rownd=r)
+            return script
+
+        with patch('games.engine.reveal_script', side_effect=late_vote):
+            with self.assertRaises(StaleGameError):
+                voting_update(self.game, True)
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.status, GameStatus.VOTING_THREE)
+
+    def test_phase_change_is_sent_when_cache_fails(self):
+        self.game.status = GameStatus.VOTING_THREE
+        self.game.save()
+        r = self.game.rounds.create(order=3, image=Image.objects.first())
+        r.guesses.create(text="Real Guess")
+
+        with patch('games.engine.GameState.save',
+                   side_effect=ConnectionError), \
+                patch('games.engine.send_channel_message') as send_message, \
+                self.assertLogs('games.engine', 'ERROR'):
+            tick(self.game)
+
+        self.assertEqual(self.game.status, GameStatus.REVEAL_THREE)
+        send_message.assert_called_with(self.game.code,
+                                        game_content_event(self.game))
 
     def test_voting_update_when_ready_for_update(self):
         self.game.status = GameStatus.VOTING_THREE
@@ -144,6 +239,30 @@ class RoundRevealTestCase(TestCase):
         guesses[1].votes.create(player=cls.players[4])
         guesses[2].votes.create(player=cls.players[0])
 
+    def test_reveal_script_shows_fewest_votes_first(self):
+        self.assertEqual(reveal_script(self.rownd), [
+            ["guess2", "player2", ["player1"]],
+            ["guess1", "player1", ["player4", "player5"]],
+            ["image title", None, ["player2", "player3"]],
+        ])
+
+    def test_reveal_is_served_from_stored_script(self):
+        self.rownd.reveal = reveal_script(self.rownd)
+        self.rownd.save()
+        self.game.reveal_step = 2
+
+        # Only the round itself is read.
+        with self.assertNumQueries(1):
+            reveal_data = shared_game_context(self.game)['reveal_data']
+
+        self.assertEqual(reveal_data['text'], "guess1")
+        self.assertEqual(reveal_data['vote_text'], "2 Votes")
+        self.assertFalse(reveal_data['correct'])
+
+        self.game.reveal_step = 3
+        self.assertTrue(shared_game_context(self.game)['reveal_data']
+                        ['correct'])
+
     def test_revealing_update_stays_revealing(self):
         result = revealing_update(self.game)
         self.assertEqual(self.game.reveal_step, 2)
@@ -151,6 +270,25 @@ class RoundRevealTestCase(TestCase):
         self.assertTrue(result)
         self.assertEqual(self.game.status, GameStatus.REVEAL_ONE)
 
+    def test_duplicate_reveal_is_rejected(self):
+        duplicate = Game.objects.get(pk=self.game.pk)
+        revealing_update(self.game)
+
+        with self.assertRaises(StaleGameError):
+            revealing_update(duplicate)
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.reveal_step, 2)
+
+    def test_tick_before_next_reveal_step_does_nothing(self):
+        self.game.next_update = timezone.now() + dt.timedelta(seconds=3)
+
+        with patch('games.engine.send_channel_message') as send_message:
+            self.assertEqual(tick(self.game), self.game.next_update)
+            send_message.assert_not_called()
+
+        self.assertEqual(self.game.reveal_step, 1)
+
     def test_revealing_update_transitions_to_show_score(self):
         self.game.reveal_step = 4
         result = revealing_update(self.game)
@@ -180,6 +318,15 @@ class RoundRevealTestCase(TestCase):
 
         self.assertTrue(result)
         self.assertEqual(self.game.status, GameStatus.COMPLETE)
+        for player in self.players:
+            self.assertEqual(list(player.seen_images.all()),
+                             [self.rownd.image])
+
+        self.game.refresh_from_db()
+        final = self.game.scoring_results['final']
+        self.assertEqual(final['easiest_prompt']['votes'], 2)
+        self.assertEqual([answer['caption'] for answer in
+                          final['best_answers']], ['guess1', 'guess2'])
 
 
 class ScoringTestCase(TestCase):
@@ -253,3 +400,115 @@ class ScoringTestCase(TestCase):
                     .get('round_totals')
                     .get(self.rownd.order)
                     .get(other.id), 0)
+
+    def test_every_vote_scored_in_fixed_queries(self):
+        correct = self.rownd.guesses.get(player=None)
+        for i, player in enumerate(self.players):
+            if i % 2:
+                correct.votes.create(player=player)
+            else:
+                author = self.players[(i + 1) % len(self.players)]
+                self.rownd.guesses.get(player=author).votes.create(
+                    player=player)
+
+        # The players, the round's votes and the write.
+        with self.assertNumQueries(3):
+            compute_score(self.rownd, self.game)
+
+        self.assertEqual(
+            self.game.scoring_results['round_totals'][self.rownd.order],
+            {self.players[0].id: 1, self.players[1].id: 3,
+             self.players[2].id: 0, self.players[3].id: 3,
+             self.players[4].id: 0})
+
+    def test_scoring_moves_version_on(self):
+        version = self.game.version
+
+        compute_score(self.rownd, self.game)
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.version, version + 1)
+        self.assertIn('1', self.game.scoring_results['round_totals'])
+
+    def test_reveal_saves_scores_with_its_step(self):
+        guess = self.rownd.guesses.get(player=self.players[0])
+        guess.votes.create(player=self.players[1])
+
+        revealing_update(self.game)
+
+        self.game.refresh_from_db()
+        self.assertEqual(self.game.reveal_step, 2)
+        self.assertEqual(
+            self.game.scoring_results['round_totals']['1'],
+            {str(player.id): int(player == self.players[0])
+             for player in self.players})
+
+
+class AnswerSubmittedTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = Player.objects.create(nickname='owner')
+        cls.game = Game.objects.create(code='ABCD',
+                                       status=GameStatus.GUESSING_ONE,
+                                       next_update=timezone.now(),
+                                       owner=cls.owner)
+        cls.game.players.add(cls.owner)
+        content_file = ContentFile("not a real image",
+                                   name="image")
+        image = Image.objects.create(file=content_file,
+                                     caption="image title")
+        cls.rownd = Round.objects.create(game=cls.game, order=1, image=image)
+        cls.correct = cls.rownd.guesses.create(player=None, text=image.caption)
+
+    def test_waits_for_other_players(self):
+        with patch('games.engine.send_channel_message') as send_message:
+            self.assertIsNone(answer_submitted(self.game))
+            send_message.assert_not_called()
+
+        self.assertEqual(self.game.status, GameStatus.GUESSING_ONE)
+
+    def test_last_guess_starts_voting(self):
+        self.rownd.guesses.create(player=self.owner, text="My Guess")
+
+        with patch('games.engine.send_channel_message') as send_message:
+            self.assertIsNotNone(answer_submitted(self.game))
+            send_message.assert_called_with(self.game.code,
+                                            game_content_event(self.game))
+
+        self.assertEqual(self.game.status, GameStatus.VOTING_ONE)
+
+    def test_last_vote_starts_reveal(self):
+        self.game.status = GameStatus.VOTING_ONE
+        self.correct.votes.create(player=self.owner)
+
+        with patch('games.engine.send_channel_message'):
+            self.assertIsNotNone(answer_submitted(self.game))
+
+        self.assertEqual(self.game.status, GameStatus.REVEAL_ONE)
+
+    def test_tick_before_deadline_does_not_count_answers(self):
+        self.game.next_update = timezone.now() + dt.timedelta(seconds=30)
+
+        with patch('games.engine.send_channel_message'):
+            with self.assertNumQueries(0):
+                tick(self.game)
+
+        self.assertEqual(self.game.status, GameStatus.GUESSING_ONE)
+
+    def test_tick_before_deadline_resyncs_countdown(self):
+        self.game.next_update = timezone.now() + dt.timedelta(seconds=30)
+
+        with patch('games.engine.send_channel_message') as send_message:
+            next_tick = tick(self.game)
+            send_message.assert_called_once_with(
+                self.game.code,
+                {"type": "countdown_update",
+                 "deadline": int(self.game.next_update.timestamp() * 1000)})
+
+        self.assertLess(next_tick, self.game.next_update)
+
+    def test_tick_wakes_at_deadline(self):
+        self.game.next_update = timezone.now() + dt.timedelta(seconds=2)
+
+        with patch('games.engine.send_channel_message'):
+            self.assertEqual(tick(self.game), self.game.next_update)
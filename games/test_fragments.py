@@ -0,0 +1,88 @@
+import os
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.test import Client, TestCase, override_settings
+from images.models import Image
+
+from games.fragments import (SERVER_NOW, cached_shared_context,
+                             render_game_content)
+from games.models import Game, GameStatus, Player, Round
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'test-fragments',
+    },
+})
+class FragmentCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = Player.objects.create(nickname="owner")
+        cls.player = Player.objects.create(nickname="player")
+        cls.game = Game.objects.create(code='ABCD', owner=cls.owner,
+                                       status=GameStatus.GUESSING_ONE,
+                                       scoring_results={'round_totals': {}})
+        cls.game.players.add(cls.owner, cls.player)
+        image = Image.objects.create(caption="image title",
+                                     file=ContentFile("not a real image",
+                                                      name="image"))
+        cls.rownd = Round.objects.create(game=cls.game, order=1, image=image)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        img_dir = os.path.join(settings.MEDIA_ROOT, "images")
+        for f in os.listdir(img_dir):
+            if f.startswith("image"):
+                os.remove(os.path.join(img_dir, f))
+
+    def setUp(self):
+        caches['fragments'].clear()
+        self.game.refresh_from_db()
+
+    def test_players_seeing_the_same_page_share_a_render(self):
+        shared = cached_shared_context(self.game)
+        render_game_content(shared, self.owner)
+
+        with self.assertNumQueries(0):
+            shared = cached_shared_context(self.game)
+        _, player_html = render_game_content({**shared, 'img_src': 'x'},
+                                             self.player)
+
+        self.assertIn(shared['img_src'], player_html)
+        self.assertNotIn('src="x"', player_html)
+        self.assertNotIn(SERVER_NOW, player_html)
+
+    def test_answering_moves_players_to_a_new_page(self):
+        _, html = render_game_content(cached_shared_context(self.game),
+                                      self.player)
+        self.assertIn("What prompt generated this picture", html)
+
+        self.client = Client()
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        with patch('games.views.notify_game_clock'):
+            self.client.post("/games/make_guess/",
+                             {"rownd_id": self.rownd.id, "guess": "frog lips"})
+
+        self.game.refresh_from_db()
+        _, html = render_game_content(cached_shared_context(self.game),
+                                      self.player)
+        self.assertIn("Guess submitted", html)
+
+    def test_reloading_the_game_page_hits_the_cache(self):
+        self.client = Client()
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        url = f"/games/play/?code={self.game.code}"
+
+        # The first visit leaves the signed player cookie behind, so the
+        # reload only loads the game, its players and its owner.
+        self.client.get(url)
+        with self.assertNumQueries(3):
+            result = self.client.get(url)
+
+        self.assertIn(b"What prompt generated this picture", result.content)
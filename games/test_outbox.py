@@ -0,0 +1,60 @@
+from unittest.mock import AsyncMock, patch
+
+from django.test import SimpleTestCase
+
+from games.outbox import Outbox, outbox_stats
+
+
+class OutboxTestCase(SimpleTestCase):
+    def setUp(self):
+        outbox_stats.clear()
+        patcher = patch('games.outbox.get_channel_layer')
+        self.group_send = AsyncMock()
+        patcher.start().return_value.group_send = self.group_send
+        self.addCleanup(patcher.stop)
+
+    def test_messages_go_out_in_order(self):
+        outbox = Outbox()
+        for i in range(5):
+            outbox.put(['ABCD'], {'type': 'countdown_update', 'n': i})
+        self.assertTrue(outbox.flush(5))
+
+        self.assertEqual([call.args[1]['n']
+                          for call in self.group_send.await_args_list],
+                         [0, 1, 2, 3, 4])
+        self.assertEqual(outbox_stats['sent'], 5)
+        self.assertEqual(outbox.depth(), 0)
+
+    def test_full_outbox_drops_oldest(self):
+        outbox = Outbox(size=2)
+        with patch.object(outbox, '_start'):
+            for i in range(3):
+                outbox.put(['ABCD'], {'type': 'countdown_update', 'n': i})
+
+        self.assertEqual(outbox.depth(), 2)
+        self.assertEqual(outbox_stats['dropped'], 1)
+        self.assertEqual(outbox.queue.get_nowait()[1]['n'], 1)
+
+    def test_failed_sends_are_retried(self):
+        self.group_send.side_effect = [ConnectionError(), None]
+        outbox = Outbox()
+
+        with patch('games.outbox.RETRY_WAIT', 0):
+            outbox.put(['ABCD'], {'type': 'refresh_game_content'})
+            self.assertTrue(outbox.flush(5))
+
+        self.assertEqual(self.group_send.await_count, 2)
+        self.assertEqual(outbox_stats['retried'], 1)
+        self.assertEqual(outbox_stats['sent'], 1)
+
+    def test_message_is_given_up_on_after_retries(self):
+        self.group_send.side_effect = ConnectionError()
+        outbox = Outbox()
+
+        with patch('games.outbox.RETRY_WAIT', 0):
+            with self.assertLogs('games.outbox', 'ERROR'):
+                outbox.put(['ABCD'], {'type': 'refresh_game_content'})
+                self.assertTrue(outbox.flush(5))
+
+        self.assertEqual(outbox_stats['failed'], 1)
+        self.assertEqual(outbox_stats['sent'], 0)
@@ -0,0 +1,74 @@
+import datetime as dt
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from games.models import Game, GameStatus, Player
+from games.state import GameState, record_answer
+
+
+class GameStateTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        owner = Player.objects.create(nickname='owner')
+        other = Player.objects.create(nickname='other')
+        cls.game = Game.objects.create(
+            code='ABCD',
+            status=GameStatus.GUESSING_TWO,
+            next_update=timezone.now() + dt.timedelta(seconds=30),
+            scoring_results={'players': {owner.id: 'owner',
+                                         other.id: 'other'},
+                             'round_totals': {}},
+            owner=owner)
+        cls.owner = owner
+        cls.other = other
+
+    def setUp(self):
+        cache.clear()
+
+    def test_state_round_trips_through_cache(self):
+        GameState.from_game(self.game).save()
+
+        state = GameState.get_many([self.game.id])[self.game.id]
+        self.assertEqual(state.code, 'ABCD')
+        self.assertEqual(state.status, GameStatus.GUESSING_TWO)
+        self.assertEqual(state.player_count, 2)
+        self.assertAlmostEqual(state.next_update, self.game.next_update,
+                               delta=dt.timedelta(milliseconds=1))
+
+    def test_delete(self):
+        GameState.from_game(self.game).save()
+        GameState.delete(self.game.id)
+
+        self.assertEqual(GameState.get_many([self.game.id]), {})
+
+    def test_counting_down(self):
+        state = GameState.from_game(self.game)
+
+        self.assertTrue(state.counting_down(timezone.now()))
+        self.assertFalse(state.counting_down(self.game.next_update))
+
+    def test_waiting_on_players_until_everyone_answers(self):
+        state = GameState.from_game(self.game)
+        state.save()
+
+        record_answer(self.game.id, self.game.status, self.owner.id)
+        self.assertTrue(state.waiting_on_players())
+
+        record_answer(self.game.id, self.game.status, self.other.id)
+        self.assertFalse(state.waiting_on_players())
+
+    def test_players_only_count_once(self):
+        state = GameState.from_game(self.game)
+        state.save()
+
+        record_answer(self.game.id, self.game.status, self.owner.id)
+        record_answer(self.game.id, self.game.status, self.owner.id)
+
+        self.assertTrue(state.waiting_on_players())
+
+    def test_lost_counter_is_not_waiting(self):
+        state = GameState.from_game(self.game)
+
+        self.assertFalse(state.waiting_on_players())
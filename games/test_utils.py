@@ -1,12 +1,16 @@
 import os
+import random
+from unittest.mock import AsyncMock, patch
 
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test import TestCase
 from images.models import Image
 
-from games.models import Game, Player
-from games.utils import finished_game_context
+from games.models import Game, GameStatus, Player
+from games.outbox import outbox
+from games.utils import (_scoreboard, final_results, player_game_context,
+                         send_channel_message, shared_game_context, standings)
 
 
 class UtilsTestCase(TestCase):
@@ -38,12 +42,17 @@ class UtilsTestCase(TestCase):
             if f.startswith("image"):
                 os.remove(os.path.join(img_dir, f))
 
+    def _finished_context(self, game=None):
+        game = game or Game.objects.get(pk=self.game.pk)
+        game.status = GameStatus.COMPLETE
+        return player_game_context(shared_game_context(game), self.player1)
+
     def test_single_best_vote_getter(self):
         rownd = self.game.rounds.get(order=3)
         guess = rownd.guesses.exclude(player=None).get(player=self.player1)
         guess.votes.create(player=self.player2)
 
-        result = finished_game_context(self.game, self.player1)
+        result = self._finished_context()
         self.assertEqual(result.get('best_answers'), [{'votes': 1,
                                                        'guesser': 'P1',
                                                        'caption': 'Player 1 guess 3',
@@ -59,7 +68,7 @@ class UtilsTestCase(TestCase):
         guess = rownd4.guesses.exclude(player=None).get(player=self.player2)
         guess.votes.create(player=self.player1)
 
-        result = finished_game_context(self.game, self.player1)
+        result = self._finished_context()
         self.assertEqual(result.get('best_answers'), [{'votes': 2,
                                                        'guesser': 'P1',
                                                        'caption': 'Player 1 guess 3',
@@ -75,7 +84,7 @@ class UtilsTestCase(TestCase):
             guess = r.guesses.filter(player=None).first()
             guess.votes.create(player=self.player2)
 
-        result = finished_game_context(self.game, self.player1)
+        result = self._finished_context()
         self.assertEqual(result.get('hardest_prompt'), {'votes': 0,
                                                         'guesser': None,
                                                         'caption': rownd.image.caption,
@@ -86,12 +95,119 @@ class UtilsTestCase(TestCase):
         guess = rownd.guesses.filter(player=None).first()
         guess.votes.create(player=self.player2)
 
-        result = finished_game_context(self.game, self.player1)
+        result = self._finished_context()
         self.assertEqual(result.get('easiest_prompt'), {'votes': 1,
                                                         'guesser': None,
                                                         'caption': rownd.image.caption,
                                                         'img_src': rownd.image.file.url})
 
     def test_easiest_prompt_is_empty(self):
-        result = finished_game_context(self.game, self.player1)
+        result = self._finished_context()
         self.assertEqual(result.get('easiest_prompt'), None)
+
+    def test_stored_results_are_served_without_queries(self):
+        game = Game.objects.get(pk=self.game.pk)
+        game.status = GameStatus.COMPLETE
+        game.scoring_results['final'] = final_results(game)
+
+        with self.assertNumQueries(0):
+            result = self._finished_context(game)
+
+        self.assertTrue(result['is_owner'])
+        self.assertEqual(result['easiest_prompt'], None)
+        self.assertEqual([entry['name'] for entry in result['scoreboard']],
+                         ['P1', 'P2'])
+
+    def test_shared_context_is_built_once_for_everyone(self):
+        self.game.status = GameStatus.VOTING_TWO
+        rownd = self.game.rounds.get(order=2)
+        rownd.guesses.get(player=self.player1).votes.create(
+            player=self.player2)
+
+        with self.assertNumQueries(3):
+            shared = shared_game_context(self.game)
+
+        with self.assertNumQueries(0):
+            context1 = player_game_context(shared, self.player1)
+            context2 = player_game_context(shared, self.player2)
+
+        self.assertFalse(context1['already_voted'])
+        self.assertTrue(context2['already_voted'])
+        self.assertEqual(sorted(g['text'] for g in context1['round_guesses']),
+                         ['Player 2 guess 2', 'image 1 title'])
+        self.assertEqual(sorted(g['text'] for g in context2['round_guesses']),
+                         ['Player 1 guess 2', 'image 1 title'])
+        self.game.status = GameStatus.STARTING
+
+    def test_guess_order_leaves_global_random_alone(self):
+        self.game.status = GameStatus.VOTING_TWO
+        shared = shared_game_context(self.game)
+        state = random.getstate()
+
+        first = player_game_context(shared, self.player1)['round_guesses']
+        again = player_game_context(shared, self.player1)['round_guesses']
+
+        self.assertEqual(random.getstate(), state)
+        self.assertEqual(first, again)
+        self.assertEqual(sorted(g['text'] for g in first),
+                         ['Player 2 guess 2', 'image 1 title'])
+        self.game.status = GameStatus.STARTING
+
+
+class StandingsTestCase(TestCase):
+    def test_ties_share_a_place_and_places_stay_dense(self):
+        round_totals = {'1': {'1': 3, '2': 1, '3': 3},
+                        2: {1: 0, 2: 2, 3: 1, 4: 0}}
+
+        self.assertEqual(standings(round_totals, [1, 2, 3, 4]),
+                         [[3, 4, 1], [1, 3, 2], [2, 3, 2], [4, 0, 3]])
+
+    def test_large_rooms_are_ranked_by_total(self):
+        player_ids = range(1, 61)
+        round_totals = {1: {id: id % 7 for id in player_ids},
+                        2: {id: id % 3 for id in player_ids}}
+
+        ranked = standings(round_totals, player_ids)
+
+        totals = [total for _, total, _ in ranked]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        self.assertEqual([place for _, _, place in ranked][-1],
+                         len(set(totals)))
+
+    def test_scoreboard_reads_stored_standings(self):
+        game = Game(scoring_results={
+            'players': {'1': 'al', '2': 'bo', '3': 'cy'},
+            'round_totals': {'1': {'1': 2, '2': 3, '3': 2}},
+            'standings': [[2, 3, 1], [1, 2, 2], [3, 2, 2]]})
+
+        with self.assertNumQueries(0):
+            scoreboard = _scoreboard(game)
+
+        self.assertEqual(scoreboard, [
+            {'name': 'bo', 'score': 3, 'place': 1, 'color': 'bg-yellow-400'},
+            {'name': 'al', 'score': 2, 'place': 2,
+             'color': 'bg-gray-400 text-white'},
+            {'name': 'cy', 'score': 2, 'place': 2,
+             'color': 'bg-gray-400 text-white'},
+        ])
+
+
+class SendChannelMessageTestCase(TestCase):
+    def test_send_to_whole_game(self):
+        with patch('games.outbox.get_channel_layer') as get_channel_layer:
+            group_send = get_channel_layer.return_value.group_send = AsyncMock()
+            send_channel_message('ABCD', {'type': 'refresh_game_content'})
+            outbox.flush()
+
+        group_send.assert_awaited_once_with('ABCD',
+                                            {'type': 'refresh_game_content'})
+
+    def test_send_to_some_players(self):
+        with patch('games.outbox.get_channel_layer') as get_channel_layer:
+            group_send = get_channel_layer.return_value.group_send = AsyncMock()
+            send_channel_message('ABCD', {'type': 'owner_message'},
+                                 players=[1, 3])
+            outbox.flush()
+
+        self.assertEqual([call.args[0] for call in group_send.await_args_list],
+                         ['ABCD-player-1', 'ABCD-player-3'])
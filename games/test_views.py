@@ -4,6 +4,7 @@ from unittest.mock import patch
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core import signing
 from django.core.files.base import ContentFile
 from django.template import loader
 from django.test import Client, TestCase
@@ -12,6 +13,7 @@ from images.models import Image
 
 from games.engine import compute_score
 from games.models import Game, GameStatus, Player, Round
+from games.players import PLAYER_COOKIE, PLAYER_COOKIE_SALT, sign_player
 from games.utils import running_game_context
 
 
@@ -38,7 +40,8 @@ class GameJoinTestCase(TestCase):
 
     def test_create_game_as_anonymous_user(self):
         self.client.cookies.load({'player_id': self.player.anonymous_user_id})
-        result = self.client.post('/games/create/', {'nickname': 'al'})
+        with patch('games.views.allocate_game_code', return_value='WXYZ'):
+            result = self.client.post('/games/create/', {'nickname': 'al'})
 
         self.assertTrue(Game.objects.filter(owner=self.player).exists())
         self.assertEqual(result.status_code, 302)
@@ -48,7 +51,8 @@ class GameJoinTestCase(TestCase):
 
     def test_create_game_as_logged_in_user(self):
         self.client.login(username=self.user.username, password=self.password)
-        result = self.client.post('/games/create/', {'nickname': 'al'})
+        with patch('games.views.allocate_game_code', return_value='WXYZ'):
+            result = self.client.post('/games/create/', {'nickname': 'al'})
 
         self.assertTrue(Game.objects.filter(owner=self.user_player).exists())
         self.assertEqual(result.status_code, 302)
@@ -57,10 +61,12 @@ class GameJoinTestCase(TestCase):
         self.assertEqual(self.user_player.nickname, 'al')
 
     def test_create_game_as_unknown_user(self):
-        result = self.client.post('/games/create/', {'nickname': 'al'})
+        with patch('games.views.allocate_game_code', return_value='WXYZ'):
+            result = self.client.post('/games/create/', {'nickname': 'al'})
 
         id = result.cookies.get('player_id').value
         game = Game.objects.filter(owner__anonymous_user_id=id).first()
+        self.assertEqual(game.code, 'WXYZ')
         self.assertTrue(f"code={game.code}" in result.url)
         self.assertEqual(result.status_code, 302)
 
@@ -70,9 +76,9 @@ class GameJoinTestCase(TestCase):
         with patch('games.views.send_channel_message') as send_message:
             result = self.client.post('/games/join/', {'code': self.game.code,
                                                        'nickname': 'al'})
-            send_message.assert_called_with(self.game.code,
-                                            {"type": "player_added",
-                                             "player": "al"})
+            send_message.assert_any_call(self.game.code,
+                                         {"type": "player_added",
+                                          "player": "al"})
 
         self.assertEqual(result.status_code, 302)
         self.assertTrue(self.game in self.player.played_games.all())
@@ -80,6 +86,46 @@ class GameJoinTestCase(TestCase):
         self.player.refresh_from_db()
         self.assertEqual(self.player.nickname, 'al')
 
+    def test_signed_cookie_is_rewritten_with_new_nickname(self):
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.player)})
+
+        with patch('games.views.send_channel_message'):
+            result = self.client.post('/games/join/', {'code': self.game.code,
+                                                       'nickname': 'al'})
+
+        self.assertTrue(self.game in self.player.played_games.all())
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.nickname, 'al')
+        self.assertEqual(self.player.user, None)
+        self.assertEqual(result.cookies[PLAYER_COOKIE].value,
+                         sign_player(self.player))
+
+    def test_forged_signed_cookie_is_ignored(self):
+        cookie = signing.dumps([self.player.id,
+                                str(self.player.anonymous_user_id),
+                                'player1', None],
+                               key='not the secret', salt=PLAYER_COOKIE_SALT)
+        self.client.cookies.load({PLAYER_COOKIE: cookie,
+                                  'player_id': self.user_player
+                                  .anonymous_user_id})
+
+        with patch('games.views.send_channel_message'):
+            self.client.post('/games/join/', {'code': self.game.code,
+                                              'nickname': 'al'})
+
+        self.assertFalse(self.game in self.player.played_games.all())
+
+    def test_signed_cookie_of_another_user_is_ignored(self):
+        self.client.login(username=self.user.username, password=self.password)
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.player)})
+
+        with patch('games.views.send_channel_message'):
+            self.client.post('/games/join/', {'code': self.game.code,
+                                              'nickname': 'al'})
+
+        self.assertFalse(self.game in self.player.played_games.all())
+        self.assertTrue(self.game in self.user_player.played_games.all())
+
     def test_join_game_code_is_not_case_sensitive(self):
         self.client.cookies.load({'player_id': self.player.anonymous_user_id})
 
@@ -87,9 +133,13 @@ class GameJoinTestCase(TestCase):
             result = self.client.post('/games/join/', {'code':
                                                        self.game.code.lower(),
                                                        'nickname': 'al'})
-            send_message.assert_called_with(self.game.code,
-                                            {"type": "player_added",
-                                             "player": "al"})
+            send_message.assert_any_call(self.game.code,
+                                         {"type": "player_added",
+                                          "player": "al"})
+            args, kwargs = send_message.call_args
+            self.assertEqual(kwargs, {'players': [self.user_player.id]})
+            self.assertIn("We need at least two players to begin",
+                          args[1]["html"])
 
         self.assertEqual(result.status_code, 302)
         self.assertTrue(self.game in self.player.played_games.all())
@@ -221,7 +271,9 @@ class GameRegisteringTestCase(TestCase):
         self.client.cookies.load({'player_id': self.owner.anonymous_user_id})
 
         with patch('games.views.send_channel_message') as send_message:
-            result = self.client.post(f"/games/cancel/{self.game.code}/")
+            with patch('games.views.release_game_code') as release_code:
+                result = self.client.post(f"/games/cancel/{self.game.code}/")
+                release_code.assert_called_once_with(self.game.code)
             send_message.assert_called_with(self.game.code,
                                             {"type": "cancel_game"})
 
@@ -230,6 +282,24 @@ class GameRegisteringTestCase(TestCase):
         self.assertEqual(self.game.status, GameStatus.ABANDONED)
         self.assertTrue('Cancelled' in self.game.scoring_results['status'])
 
+    def test_owner_starts_game_clock(self):
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.owner)})
+
+        with patch('games.views.notify_game_clock') as notify:
+            result = self.client.post(f"/games/start/{self.game.code}/")
+            notify.assert_called_once_with(self.game.id)
+
+        self.assertEqual(result.status_code, 200)
+
+    def test_start_game_clock_ignores_non_owner(self):
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.player)})
+
+        with patch('games.views.notify_game_clock') as notify:
+            result = self.client.post(f"/games/start/{self.game.code}/")
+            notify.assert_not_called()
+
+        _unknown_code(self, result)
+
 
 class GameInProgressTestCase(TestCase):
     @classmethod
@@ -295,13 +365,52 @@ class GameInProgressTestCase(TestCase):
             "guess": guess_text
         }
 
-        result = self.client.post("/games/make_guess/", data)
+        with patch('games.views.notify_game_clock') as notify:
+            result = self.client.post("/games/make_guess/", data)
+            notify.assert_called_with(self.game.id, event='answer')
 
         self.assertTrue(b"Guess submitted" in result.content)
 
         self.assertTrue(self.player.guesses
                         .filter(rownd=self.rownd,
                                 text=guess_text.upper()).count() == 1)
+        self.assertEqual(Game.objects.get(pk=self.game.pk).version,
+                         self.game.version + 1)
+
+    def test_guess_is_kept_when_clock_cant_be_told(self):
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        data = {"rownd_id": self.rownd.id, "guess": "frog lips"}
+
+        with patch('games.views.notify_game_clock',
+                   side_effect=ConnectionError), \
+                self.assertLogs('games.views', 'ERROR'):
+            result = self.client.post("/games/make_guess/", data)
+
+        self.assertTrue(b"Guess submitted" in result.content)
+        self.assertTrue(self.player.guesses.filter(rownd=self.rownd).exists())
+
+    def test_guess_is_kept_when_it_cant_be_counted(self):
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        data = {"rownd_id": self.rownd.id, "guess": "frog lips"}
+
+        with patch('games.views.record_answer',
+                   side_effect=ConnectionError), \
+                patch('games.views.notify_game_clock') as notify, \
+                self.assertLogs('games.views', 'ERROR'):
+            result = self.client.post("/games/make_guess/", data)
+
+        self.assertTrue(b"Guess submitted" in result.content)
+        notify.assert_called_with(self.game.id, event='answer')
+
+    def test_guess_query_budget(self):
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.player)})
+        data = {"rownd_id": self.rownd.id, "guess": "frog lips"}
+
+        # Round and membership, insert and version bump, plus the savepoint
+        # around them.
+        with patch('games.views.notify_game_clock'):
+            with self.assertNumQueries(5):
+                self.client.post("/games/make_guess/", data)
 
     def test_player_cant_guess_twice(self):
         self.client.cookies.load({'player_id': self.player.anonymous_user_id})
@@ -374,6 +483,18 @@ class GameInProgressTestCase(TestCase):
             b"Too similar to the real caption or another player's guess"
             in result.content)
 
+    def test_show_countdown_deadline(self):
+        self.game.status = GameStatus.GUESSING_ONE
+        self.game.next_update = timezone.now() + timezone.timedelta(seconds=30)
+        self.game.save()
+
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        result = self.client.get(f"/games/play/?code={self.game.code}")
+
+        deadline = int(self.game.next_update.timestamp() * 1000)
+        self.assertTrue(f'data-deadline="{deadline}"'.encode()
+                        in result.content)
+
     def test_show_answered_to_active_player(self):
         self.rownd.guesses.create(player=self.player,
                                   text="HOTDOG")
@@ -420,10 +541,42 @@ class GameInProgressTestCase(TestCase):
         guess = self.rownd.guesses.create(player=self.user_player,
                                           text="user guess")
         self.client.cookies.load({'player_id': self.player.anonymous_user_id})
-        result = self.client.post('/games/vote/', {'guess_id': guess.id})
+        with patch('games.views.notify_game_clock') as notify:
+            result = self.client.post('/games/vote/', {'guess_id': guess.id})
+            notify.assert_called_with(self.game.id, event='answer')
 
         self.assertTrue(b"Vote submitted" in result.content)
         self.assertTrue(self.player.vote_set.filter(guess=guess).exists())
+        self.assertEqual(Game.objects.get(pk=self.game.pk).version,
+                         self.game.version + 1)
+
+    def test_vote_is_kept_when_clock_cant_be_told(self):
+        self.game.status = GameStatus.VOTING_ONE
+        self.game.save()
+        guess = self.rownd.guesses.create(player=self.user_player,
+                                          text="user guess")
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+
+        with patch('games.views.notify_game_clock',
+                   side_effect=ConnectionError), \
+                self.assertLogs('games.views', 'ERROR'):
+            result = self.client.post('/games/vote/', {'guess_id': guess.id})
+
+        self.assertTrue(b"Vote submitted" in result.content)
+        self.assertTrue(self.player.vote_set.filter(guess=guess).exists())
+
+    def test_vote_query_budget(self):
+        self.game.status = GameStatus.VOTING_ONE
+        self.game.save()
+        guess = self.rownd.guesses.create(player=self.user_player,
+                                          text="user guess")
+        self.client.cookies.load({PLAYER_COOKIE: sign_player(self.player)})
+
+        # Guess and membership, insert and version bump, plus the savepoint
+        # around them.
+        with patch('games.views.notify_game_clock'):
+            with self.assertNumQueries(5):
+                self.client.post('/games/vote/', {'guess_id': guess.id})
 
     def test_non_player_cant_vote(self):
         self.game.status = GameStatus.VOTING_ONE
@@ -452,6 +605,22 @@ class GameInProgressTestCase(TestCase):
         self.assertFalse(b"Vote submitted" in result.content)
         self.assertEqual(self.player.vote_set.filter(guess=guess).count(), 1)
 
+    def test_player_cant_vote_once_voting_is_over(self):
+        self.game.status = 'S1'
+        self.game.save()
+
+        guess = self.rownd.guesses.create(player=self.user_player,
+                                          text="user guess")
+        self.client.cookies.load({'player_id': self.player.anonymous_user_id})
+        with patch('games.views.notify_game_clock') as notify:
+            result = self.client.post('/games/vote/', {'guess_id': guess.id})
+            notify.assert_not_called()
+
+        self.assertEqual(result.status_code, 400)
+        self.assertFalse(self.player.vote_set.exists())
+        self.assertEqual(Game.objects.get(pk=self.game.pk).version,
+                         self.game.version)
+
     def test_show_voted_to_active_player(self):
         self.game.status = GameStatus.VOTING_ONE
         self.game.save()
@@ -466,16 +635,21 @@ class GameInProgressTestCase(TestCase):
         self.assertTrue(b"Vote submitted" in result.content)
 
     def __setup_votes(self):
+        # Scoring checks the game's version, which an earlier test may have
+        # moved on in this shared copy before its changes were rolled back.
+        self.game.refresh_from_db()
         self.rownd.order = 3
         self.rownd.save()
         self.rownd.guesses.create(player=None,
                                   text="THIS WAS CORRECT")
         players = list(self.game.players.all())
+        voters = iter(Player.objects.create(nickname=f"voter{i}")
+                      for i in range(6))
         for i in range(3):
             guess = self.rownd.guesses.create(player=players[i],
                                               text=f"GUESS {i}")
             for j in range(1 + i):
-                guess.votes.create(player=players[(i + 1) % 3])
+                guess.votes.create(player=next(voters))
 
         compute_score(self.rownd, self.game)
 
@@ -613,11 +787,11 @@ class GameFinishedTestCase(TestCase):
         self.client.cookies.load({'player_id': self.owner.anonymous_user_id})
 
         with patch('games.views.send_channel_message') as send_message:
-            with patch('games.views.timer_tick') as timer_tick:
+            with patch('games.views.notify_game_clock') as notify:
                 result = self.client.post("/games/reuse_game_code/", data)
                 send_message.assert_called_with(self.game.code,
                                                 {"type": "new_game"})
-                timer_tick.assert_called_once()
+                notify.assert_called_once()
 
         self.assertEqual(result.status_code, 200)
         new_game = (Game.objects
@@ -641,7 +815,9 @@ class GameFinishedTestCase(TestCase):
         self.client.cookies.load({'player_id': self.owner.anonymous_user_id})
 
         with patch('games.views.send_channel_message') as send_message:
-            result = self.client.post("/games/close_game_code/", data)
+            with patch('games.views.release_game_code') as release_code:
+                result = self.client.post("/games/close_game_code/", data)
+                release_code.assert_called_once_with(self.game.code)
             send_message.assert_called_with(self.game.code,
                                             {"type": "close_game"})
 
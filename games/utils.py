@@ -1,13 +1,14 @@
 import datetime as dt
+import json
 import random
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+import redis
 from django.conf import settings
-from django.db.models import Count, Q
+from django.db.models import Count, F, Q
 from django.utils import timezone
 
-from .models import Game, GameStatus, Guess
+from .models import Game, GameStatus, Guess, Vote
+from .outbox import outbox
 
 NUM_TO_TEXT = {
     0: 'zero',
@@ -23,9 +24,63 @@ NUM_TO_TEXT = {
 }
 
 
-def send_channel_message(game_code, data):
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(game_code, data)
+GAME_CLOCK_QUEUE = 'game_clock'
+
+_redis_client = None
+
+
+def player_group(game_code, player_id):
+    return f"{game_code}-player-{player_id}"
+
+
+def send_channel_message(game_code, data, players=None):
+    """Send an event to every socket in a game, or only to some players'.
+
+    players is a list of player ids. Each of them gets the event on all of
+    their sockets for this game and nobody else sees it. The event is only
+    queued here, the outbox sends it from its own thread.
+    """
+    if players is None:
+        groups = [game_code]
+    else:
+        groups = [player_group(game_code, id) for id in players]
+
+    outbox.put(groups, data)
+
+
+def bump_version(game_id, status=None):
+    """Mark a game as changed without going through the engine.
+
+    Guesses and votes change what players see without touching the game's
+    row, so they bump its version to move cached pages on. Given a status,
+    the game is only bumped while it still has it. Returns whether it was.
+    """
+    games = Game.objects.filter(pk=game_id)
+    if status:
+        games = games.filter(status=status)
+
+    return bool(games.update(version=F('version') + 1))
+
+
+def redis_client():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(settings.REDIS_URL)
+
+    return _redis_client
+
+
+def notify_game_clock(game_id, when=None, event=None):
+    when = when or timezone.now()
+    message = {'game_id': game_id, 'at': when.timestamp()}
+    if event:
+        message['event'] = event
+
+    redis_client().rpush(GAME_CLOCK_QUEUE, json.dumps(message))
+
+
+def epoch_ms(when):
+    return when and int(when.timestamp() * 1000)
 
 
 def fetch_running_game(**query):
@@ -55,65 +110,101 @@ def status(game):
         return 'complete'
 
 
-def guesses_with_votes(rownd):
-    return (rownd.guesses
-            .exclude(player=None)
-            .annotate(vote_count=Count('votes'))
-            .filter(vote_count__gt=0)
-            .order_by('vote_count'))
+def reveal_script(rownd):
+    """Every step of a round's reveal, in the order they're shown.
 
+    Each step is [text, submitter, voters]. The guesses that got votes come
+    first, fewest votes first, and the real caption, with no submitter,
+    comes last. It's read with a single query, one row per vote.
+    """
+    steps = {}
+    rows = (rownd.guesses
+            .order_by('pk', 'votes__pk')
+            .values_list('pk', 'text', 'player__nickname',
+                         'votes__player__nickname'))
+    for pk, text, submitter, voter in rows:
+        step = steps.setdefault(pk, [text, submitter, []])
+        if voter is not None:
+            step[2].append(voter)
 
-def _reveal_data(rownd, step):
-    guesses = guesses_with_votes(rownd)
+    guesses = sorted((step for step in steps.values()
+                      if step[1] is not None and step[2]),
+                     key=lambda step: len(step[2]))
+    caption = [step for step in steps.values() if step[1] is None]
 
-    if step > guesses.count():
-        guess = rownd.guesses.filter(player=None).first()
-        correct = True
-    else:
-        guess = guesses[step - 1]
-        correct = False
+    return guesses + caption[:1]
 
-    vote_count = guess.votes.count()
-    vote_text = f"{vote_count} Vote"
-    if vote_count != 1:
+
+def _reveal_data(script, step):
+    # Any step past the guesses shows the caption.
+    text, submitter, voters = script[min(step, len(script)) - 1]
+
+    vote_text = f"{len(voters)} Vote"
+    if len(voters) != 1:
         vote_text += 's'
 
     return {
-        'text': guess.text,
-        'players': enumerate([v.player.nickname for v in guess.votes.all()]),
+        'text': text,
+        'players': list(enumerate(voters)),
         'vote_text': vote_text,
-        'correct': correct,
-        'submitter': guess.player and guess.player.nickname,
+        'correct': step >= len(script),
+        'submitter': submitter,
     }
 
 
-def _scoreboard(game):
-    totals = {p.id: {'name': p.nickname,
-                     'score': 0} for p in game.players.all()}
+PLACE_COLORS = {
+    1: 'bg-yellow-400',
+    2: 'bg-gray-400 text-white',
+    3: 'bg-yellow-900 text-white',
+}
+
 
-    for r, scores in game.scoring_results.get('round_totals').items():
-        for id, s in scores.items():
-            totals[int(id)]['score'] += s
+def standings(round_totals, player_ids):
+    """Every player's total over the rounds scored so far, with their place.
 
-    scores = sorted(set(x['score'] for x in totals.values()), reverse=True)
-    for player in totals.values():
-        player['place'] = scores.index(player['score']) + 1
-        if player['place'] == 1:
-            player['color'] = 'bg-yellow-400'
-        if player['place'] == 2:
-            player['color'] = 'bg-gray-400 text-white'
-        if player['place'] == 3:
-            player['color'] = 'bg-yellow-900 text-white'
+    Returns [player id, total, place] from the highest total down. Players
+    on the same total share a place and the next total down takes the one
+    after it, so places stay dense however many players there are.
+    """
+    totals = dict.fromkeys((int(id) for id in player_ids), 0)
+    for scores in round_totals.values():
+        for id, score in scores.items():
+            totals[int(id)] += score
 
-    totals_list = [v for k, v in totals.items()]
-    return sorted(totals_list, key=lambda x: x['score'], reverse=True)
+    ranked = []
+    place, last_total = 0, None
+    for id, total in sorted(totals.items(), key=lambda item: item[1],
+                            reverse=True):
+        if total != last_total:
+            place, last_total = place + 1, total
+        ranked.append([id, total, place])
 
+    return ranked
 
-def _random_guess_order(rownd, player):
-    guesses = list(rownd.guesses.exclude(player=player).all())
 
-    random.seed(player.id + rownd.id)
-    random.shuffle(guesses)
+def _scoreboard(game):
+    # The engine stores the standings whenever it scores a round, and the
+    # players' names when the game starts. Games from before either was
+    # stored work them out here.
+    scoring_results = game.scoring_results
+    names = scoring_results.get('players') or dict(
+        game.players.values_list('id', 'nickname'))
+    names = {int(id): name for id, name in names.items()}
+    ranked = (scoring_results.get('standings') or
+              standings(scoring_results.get('round_totals'), names))
+
+    return [{'name': names[id], 'score': total, 'place': place,
+             'color': PLACE_COLORS.get(place, '')}
+            for id, total, place in ranked]
+
+
+def _random_guess_order(rownd_id, guesses, player_id):
+    # A generator of its own, seeded the way the module's used to be, keeps
+    # each player's order the same on every render without touching the
+    # random state everything else in the process shares.
+    guesses = [g for g in guesses if g['player_id'] != player_id]
+
+    random.Random((player_id or 0) + rownd_id).shuffle(guesses)
 
     return guesses
 
@@ -122,81 +213,128 @@ def cdnify(filename):
     return f"{ settings.CDN_BASE_URL }{filename}"
 
 
-def finished_game_context(game, current_player):
-    _status = status(game)
-
-    top_guesses = [{'votes': g.vote_count,
-                    'guesser': g.player.nickname,
-                    'img_src': cdnify(g.rownd.image.file.name),
-                    'caption': g.text}
-                   for g in (Guess.objects
-                             .annotate(vote_count=Count('votes'))
-                             .filter(rownd__game=game, vote_count__gt=0)
-                             .exclude(player=None)
-                             .order_by('-vote_count')
-                             .all())][0:3]
-
-    hardest_guess = (Guess.objects
-                     .annotate(vote_count=Count('votes'))
-                     .filter(player=None, rownd__game=game)
-                     .order_by('vote_count')
-                     .first())
-    hardest_prompt = hardest_guess and {'votes': hardest_guess.vote_count,
-                                        'guesser': None,
-                                        'img_src': cdnify(hardest_guess.rownd.image.file.name),
-                                        'caption': hardest_guess.text}
-
-    easiest_guess = (Guess.objects
-                     .annotate(vote_count=Count('votes'))
-                     .filter(player=None, rownd__game=game, vote_count__gt=0)
-                     .order_by('-vote_count')
-                     .first())
-
-    easiest_prompt = easiest_guess and {'votes': easiest_guess.vote_count,
-                                        'guesser': None,
-                                        'img_src': cdnify(easiest_guess.rownd.image.file.name),
-                                        'caption': easiest_guess.text}
-
-    return {"status": _status,
+def _result_entry(guess):
+    return {'votes': guess.vote_count,
+            'guesser': guess.player and guess.player.nickname,
+            'img_src': cdnify(guess.rownd.image.file.name),
+            'caption': guess.text}
+
+
+def final_results(game):
+    """The scores and highlights a finished game is remembered by.
+
+    Nothing about them changes once the game is complete, so the engine
+    stores them then. They're worked out from a single query over every
+    guess in the game along with its votes.
+    """
+    guesses = list(Guess.objects
+                   .filter(rownd__game=game)
+                   .select_related('player', 'rownd__image')
+                   .annotate(vote_count=Count('votes'))
+                   .order_by('pk'))
+
+    answers = [g for g in guesses if g.player_id and g.vote_count]
+    prompts = [g for g in guesses if g.player_id is None]
+    best_answers = sorted(answers, key=lambda g: g.vote_count,
+                          reverse=True)[:3]
+    hardest_prompt = min(prompts, key=lambda g: g.vote_count, default=None)
+    easiest_prompt = max((g for g in prompts if g.vote_count),
+                         key=lambda g: g.vote_count, default=None)
+
+    return {"scoreboard": _scoreboard(game),
+            "best_answers": [_result_entry(g) for g in best_answers],
+            "hardest_prompt": hardest_prompt and _result_entry(hardest_prompt),
+            "easiest_prompt": easiest_prompt and _result_entry(easiest_prompt)}
+
+
+def _shared_finished_context(game):
+    # Games that finished before the results were stored work them out on
+    # every view instead.
+    results = ((game.scoring_results or {}).get('final') or
+               final_results(game))
+
+    return {"game_id": game.id,
+            "version": game.version,
+            "status": status(game),
             "code": game.code,
             "title": "Final Score",
-            "is_owner": game.owner == current_player,
+            "owner_id": game.owner_id,
             "is_closed": game.closed,
-            "scoreboard": _scoreboard(game),
-            "best_answers": top_guesses,
-            "hardest_prompt": hardest_prompt,
-            "easiest_prompt": easiest_prompt}
+            **results}
 
 
-def running_game_context(game, current_player):
+def _player_finished_context(shared, player_id):
+    return {**shared, "is_owner": shared['owner_id'] == player_id}
+
+
+def shared_game_context(game):
+    """The parts of a running game's page that every player sees.
+
+    It only holds plain data, so it can be built once when the game changes
+    and sent along with the refresh event for each socket to finish off with
+    player_game_context.
+    """
     _status = status(game)
 
     if _status == 'complete':
-        return finished_game_context(game, current_player)
+        return _shared_finished_context(game)
 
-    rownd = int(game.status[1])
-
-    rownd = game.rounds.filter(order=rownd).first()
+    rownd = (game.rounds.select_related('image')
+             .filter(order=int(game.status[1])).first())
     rownd_id = rownd and rownd.id
-    already_guessed = rownd and rownd.guesses.filter(
-        player=current_player).exists()
-    already_voted = rownd and rownd.guesses.filter(
-        votes__player=current_player).exists()
-    _status = status(game)
+    guesses = (rownd and _status in ('guessing', 'voting') and
+               list(rownd.guesses.order_by('pk')
+                    .values('id', 'text', 'player_id'))) or []
+    voted = (rownd and _status == 'voting' and
+             list(Vote.objects.filter(guess__rownd=rownd)
+                  .values_list('player_id', flat=True))) or []
 
     return {
+        "game_id": game.id,
+        "version": game.version,
         "rownd_id": rownd_id,
         "img_src": rownd_id and cdnify(rownd.image.file.name),
-        "already_guessed": already_guessed,
-        "already_voted": already_voted,
         "round_title": rownd and NUM_TO_TEXT.get(rownd.order, "").upper(),
         "status": _status,
-        "round_guesses": (_status == 'voting' and
-                          _random_guess_order(rownd, current_player)),
+        "guesses": guesses,
+        "guessed": [g['player_id'] for g in guesses if g['player_id']],
+        "voted": voted,
         "reveal_data": (_status == 'revealing' and
-                        _reveal_data(rownd, game.reveal_step)),
+                        _reveal_data(rownd.reveal or reveal_script(rownd),
+                                     game.reveal_step)),
+        "deadline": (_status in ('guessing', 'voting') and
+                     epoch_ms(game.next_update)),
         "show_scoreboard": game.reveal_step >= 99,
-        "show_keyboard": _status == 'guessing' and not already_guessed,
         "scoreboard": (_status == 'revealing' and game.reveal_step >= 99 and
                        _scoreboard(game))
     }
+
+
+def player_game_context(shared, current_player):
+    player_id = current_player and current_player.id
+
+    if shared['status'] == 'complete':
+        return _player_finished_context(shared, player_id)
+
+    already_guessed = player_id in shared['guessed']
+
+    return {
+        **shared,
+        "already_guessed": already_guessed,
+        "already_voted": player_id in shared['voted'],
+        "round_guesses": (shared['status'] == 'voting' and
+                          shared['rownd_id'] and
+                          _random_guess_order(shared['rownd_id'],
+                                              shared['guesses'], player_id)),
+        "server_now": epoch_ms(timezone.now()),
+        "show_keyboard": shared['status'] == 'guessing' and not already_guessed,
+    }
+
+
+def running_game_context(game, current_player):
+    return player_game_context(shared_game_context(game), current_player)
+
+
+def game_content_event(game):
+    return {"type": "refresh_game_content",
+            "context": shared_game_context(game)}
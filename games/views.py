@@ -1,23 +1,30 @@
-import datetime as dt
-import random
-import string
+import logging
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
 from django.db.models.functions import Length
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.template import loader
 from django.utils import timezone
 
-from .engine import timer_tick
+from .codes import allocate_game_code, release_game_code
 from .forms import GameForm, GuessForm, JoinForm, VoteForm
+from .fragments import cached_shared_context, render_game_content
 from .models import Game, GameStatus, Guess, Player, Round
-from .utils import (NUM_TO_TEXT, cdnify, fetch_recent_game, fetch_running_game,
+from .players import PLAYER_COOKIE, player_from_cookie, set_player_cookie
+from .state import record_answer
+from .utils import (NUM_TO_TEXT, bump_version, cdnify, epoch_ms,
+                    fetch_recent_game, fetch_running_game, notify_game_clock,
                     running_game_context, send_channel_message, status)
 
 FULL_GAME = 8
 
+logger = logging.getLogger(__name__)
+
 
 def index(request):
     template = loader.get_template('index.html')
@@ -34,7 +41,14 @@ def index(request):
 
 
 def _get_player(request, create=True):
-    if request.user.is_authenticated:
+    # The signed cookie only stands in for the player it was issued to while
+    # the same user, or nobody, is logged in.
+    user_id = request.user.id if request.user.is_authenticated else None
+    player = player_from_cookie(request.COOKIES)
+    if player and player.user_id == user_id:
+        return player
+
+    if user_id:
         user_player = Player.objects.filter(user=request.user).first()
         if not user_player:
             user_player = Player.objects.create(user=request.user)
@@ -52,16 +66,6 @@ def _get_player(request, create=True):
         return Player.objects.create()
 
 
-def _new_game_code():
-    return ''.join(random.choice(string.ascii_letters)
-                   for _ in range(4)).upper()
-
-
-def _set_player_cookie(response, player):
-    response.set_cookie('player_id', str(player.anonymous_user_id),
-                        expires=timezone.now() + dt.timedelta(days=365))
-
-
 def game_create(request):
     if request.method == 'POST':
         form = GameForm(request.POST)
@@ -69,9 +73,7 @@ def game_create(request):
         player = _get_player(request)
 
         if player and form.is_valid():
-            code = _new_game_code()
-            while fetch_running_game(code=code):
-                code = _new_game_code()
+            code = allocate_game_code()
 
             game = Game.objects.create(code=code,
                                        owner=player)
@@ -82,7 +84,7 @@ def game_create(request):
 
             response = HttpResponseRedirect(
                 f"/games/play/?code={game.code}")
-            _set_player_cookie(response, player)
+            set_player_cookie(response, player)
             return response
         else:
             print("We're in the else", player, form.is_valid())
@@ -97,62 +99,87 @@ def _unknown_game(request):
                                          'show_howto': True}, request))
 
 
-def show_game(request):
-    code = request.GET.get('code', None)
+def _game_page(request, code):
+    # Everything the game page needs from the database, in one trip off the
+    # event loop. None when the player can't see the game.
+    game = fetch_running_game(code=code)
 
-    if code:
-        game = fetch_running_game(code=code.upper())
-
-        current_player = _get_player(request, False)
+    current_player = _get_player(request, False)
 
+    if not game:
+        game = current_player and fetch_recent_game(code=code,
+                                                    players=current_player)
         if not game:
-            recent_game = current_player and fetch_recent_game(code=code.upper(), players=current_player)
-            if not recent_game:
-                return _unknown_game(request)
-            else:
-                game = recent_game
+            return None
+
+    players = list(game.players.all())
+    if game.status != GameStatus.STARTING and current_player not in players:
+        return None
+
+    warnings = messages.get_messages(request)
+    duplicate_warning = ""
+    for warning in warnings:
+        duplicate_warning = warning.message
+
+    is_registered = current_player and current_player in players
+    context = {
+        "current_player_id": current_player and current_player.id,
+        "player_name": (current_player and current_player.nickname) or '',
+        "registered": is_registered,
+        "is_owner": game.owner_id == (current_player and current_player.id),
+        "is_closed": game.closed,
+        "status": status(game),
+        "code": game.code,
+        "owner": game.owner.nickname.upper(),
+        "players": players,
+        "enough_players": len(players) >= 2,
+        "duplicate_warning": duplicate_warning,
+        "game_full": len(players) >= FULL_GAME,
+        "join_button": "Join",
+        "show_howto": game.status == GameStatus.STARTING,
+        "connect_code": f'ws-connect="/ws/game/{game.code}/"' if is_registered else '',
+        "include_ga": settings.ENVIRONMENT == "production",
+    }
+    shared = (game.status != GameStatus.STARTING and
+              cached_shared_context(game))
+
+    return context, current_player, shared
+
+
+async def show_game(request):
+    code = request.GET.get('code', None)
 
-        if game.status != GameStatus.STARTING and (current_player not in
-                                                   game.players.all()):
+    if code:
+        page = await sync_to_async(_game_page)(request, code.upper())
+        if not page:
             return _unknown_game(request)
 
-        _status = status(game)
-
-        warnings = messages.get_messages(request)
-        duplicate_warning = ""
-        for warning in warnings:
-            duplicate_warning = warning.message
-
-        players = game.players.all()
-        is_registered = current_player and current_player in players
-        context = {
-            "current_player_id": current_player and current_player.id,
-            "player_name": (current_player and current_player.nickname) or '',
-            "registered": is_registered,
-            "is_owner": game.owner == current_player,
-            "is_closed": game.closed,
-            "status": _status,
-            "code": game.code,
-            "owner": game.owner.nickname.upper(),
-            "players": players,
-            "enough_players": len(players) >= 2,
-            "duplicate_warning": duplicate_warning,
-            "game_full": len(players) >= FULL_GAME,
-            "join_button": "Join",
-            "show_howto": game.status == GameStatus.STARTING,
-            "connect_code": f'ws-connect="/ws/game/{game.code}/"' if is_registered else '',
-            "include_ga": settings.ENVIRONMENT == "production",
-        }
-        if game.status != GameStatus.STARTING:
-            context = {**context, **running_game_context(game, current_player)}
+        context, current_player, shared = page
+        if shared:
+            player_context, html = render_game_content(shared,
+                                                       current_player)
+            context = {**context, **player_context, "game_content": html}
 
         template = loader.get_template('live_game.html')
 
-        return HttpResponse(template.render(context, request))
+        response = HttpResponse(template.render(context, request))
+        if current_player and PLAYER_COOKIE not in request.COOKIES:
+            # Players from before the signed cookie pick it up here.
+            set_player_cookie(response, current_player)
+        return response
     else:
         return HttpResponseRedirect("/")
 
 
+def _owner_message(code, count):
+    template = loader.get_template('owner_start_message.html')
+    html = template.render({'enough_players': count > 1,
+                            'game_full': count >= FULL_GAME,
+                            'code': code}, None)
+
+    return f'<div id="owner_message" hx-swap-oob="true"> { html } </div>'
+
+
 def join_game(request):
     if request.method == 'POST':
         form = JoinForm(request.POST)
@@ -170,7 +197,8 @@ def join_game(request):
             player.nickname = form.data.get('nickname')
             player.save()
 
-            joinable = (game.players.count() < FULL_GAME and
+            count = game.players.count()
+            joinable = (count < FULL_GAME and
                         player not in game.players.all())
 
             if (joinable and
@@ -182,19 +210,69 @@ def join_game(request):
 
             if joinable:
                 game.players.add(player)
+                count += 1
                 send_channel_message(game.code,
                                      {"type": "player_added",
                                       "player": player.nickname})
+                send_channel_message(game.code,
+                                     {"type": "owner_message",
+                                      "html": _owner_message(game.code,
+                                                             count)},
+                                     players=[game.owner_id])
 
             response = HttpResponseRedirect(
                 f"/games/play/?code={game.code}")
-            _set_player_cookie(response, player)
+            set_player_cookie(response, player)
             return response
 
     return HttpResponseRedirect("/")
 
 
+def _in_game(player, game_id):
+    return Exists(Game.players.through.objects
+                  .filter(game_id=OuterRef(game_id), player_id=player.id))
+
+
+class PhaseOver(Exception):
+    pass
+
+
+def _save_answer(game_id, phase, player, create, **fields):
+    # The answer and the version bump go in together, or not at all when one
+    # of the answer's constraints turns it down. The bump only applies while
+    # the game is still in the answer's phase: the engine's move to the next
+    # one checks the version, so it either sees this answer or has already
+    # happened and the answer is turned away.
+    try:
+        with transaction.atomic():
+            if not bump_version(game_id, phase):
+                raise PhaseOver
+            create(player=player, **fields)
+    except IntegrityError:
+        return False
+
+    # Without the count the phase just runs to its deadline.
+    try:
+        record_answer(game_id, phase, player.id)
+    except Exception:
+        logger.exception("Couldn't count an answer in game %s", game_id)
+
+    return True
+
+
+def _notify_answer(game_id):
+    # The answer is saved by now, and the clock still gets to the game at
+    # its deadline, so failing to tell it early mustn't fail the request.
+    try:
+        notify_game_clock(game_id, event='answer')
+    except Exception:
+        logger.exception("Couldn't tell the clock about an answer in game %s",
+                         game_id)
+
+
 def submit_guess(request):
+    # Takes three queries when the guess goes in: the round along with
+    # whether the player is in its game, the insert and the version bump.
     if request.method == 'POST':
         form = GuessForm(request.POST)
 
@@ -202,25 +280,31 @@ def submit_guess(request):
 
         if player and form.is_valid():
             rownd = get_object_or_404(
-                Round.objects.filter(pk=form.data.get('rownd_id')))
-
-            if rownd.guesses.filter(player=player).exists():
-                return HttpResponse("Only one guess allowed", status=400)
+                Round.objects
+                .select_related('game', 'image')
+                .annotate(in_game=_in_game(player, 'game_id'))
+                .filter(pk=form.data.get('rownd_id')))
 
-            if player not in rownd.game.players.all():
+            if not rownd.in_game:
                 return HttpResponse("Not in this game", status=400)
 
             guess = form.data.get('guess').upper()
             guess = guess.replace('\n', ' ')
-            sqlized_guess = guess.replace("'", "''")
 
-            query = f"UPPER(REPLACE(text,' ','')) = '{sqlized_guess.replace(' ', '')}'"
-            if rownd.guesses.extra(where=[query]).exists():
-                duplicate = True
+            # The round's constraints reject a second guess from the player,
+            # or one too close to the caption or to another player's.
+            try:
+                duplicate = not _save_answer(rownd.game_id,
+                                             'R' + str(rownd.order), player,
+                                             rownd.guesses.create, text=guess)
+            except PhaseOver:
+                return HttpResponse("Guessing is over", status=400)
+
+            if duplicate:
+                if rownd.guesses.filter(player=player).exists():
+                    return HttpResponse("Only one guess allowed", status=400)
             else:
-                duplicate = False
-                rownd.guesses.create(text=guess,
-                                     player=player)
+                _notify_answer(rownd.game_id)
 
             template = loader.get_template('guessing.html')
             return HttpResponse(template.render(
@@ -229,13 +313,18 @@ def submit_guess(request):
                  "guess": guess,
                  "rownd_id": rownd.id,
                  "img_src": cdnify(rownd.image.file.name),
-                 "round_title": NUM_TO_TEXT.get(rownd.order, "").upper()},
+                 "round_title": NUM_TO_TEXT.get(rownd.order, "").upper(),
+                 "deadline": epoch_ms(rownd.game.next_update),
+                 "server_now": epoch_ms(timezone.now())},
                 request))
 
     return HttpResponse(status=404)
 
 
 def submit_vote(request):
+    # Takes three queries when the vote goes in: the guess along with its
+    # round, game and whether the player is in it, the insert and the
+    # version bump.
     if request.method == 'POST':
         form = VoteForm(request.POST)
 
@@ -243,21 +332,29 @@ def submit_vote(request):
 
         if player and form.is_valid():
             guess = get_object_or_404(
-                Guess.objects.filter(pk=form.data.get('guess_id')))
+                Guess.objects
+                .select_related('rownd__game')
+                .annotate(in_game=_in_game(player, 'rownd__game_id'))
+                .filter(pk=form.data.get('guess_id')))
 
-            if player not in guess.rownd.game.players.all():
+            if not guess.in_game:
                 return HttpResponse("Not in this game", status=400)
 
-            if player.vote_set.filter(guess__rownd=guess.rownd).exists():
-                return HttpResponse("Only one vote allowed", status=400)
-
-            guess.votes.create(player=player)
-
             rownd = guess.rownd
+            try:
+                if not _save_answer(rownd.game_id, 'V' + str(rownd.order),
+                                    player, guess.votes.create, rownd=rownd):
+                    return HttpResponse("Only one vote allowed", status=400)
+            except PhaseOver:
+                return HttpResponse("Voting is over", status=400)
+
+            _notify_answer(rownd.game_id)
             template = loader.get_template('voting.html')
             return HttpResponse(template.render(
                 {'already_voted': True,
-                 "round_title": NUM_TO_TEXT.get(rownd.order, "").upper()},
+                 "round_title": NUM_TO_TEXT.get(rownd.order, "").upper(),
+                 "deadline": epoch_ms(rownd.game.next_update),
+                 "server_now": epoch_ms(timezone.now())},
                 request))
 
     return HttpResponse(status=404)
@@ -271,7 +368,7 @@ def start_game_clock(request, code):
     if not game:
         return _unknown_game(request)
 
-    timer_tick(game.id)
+    notify_game_clock(game.id)
 
     return HttpResponse(status=200)
 
@@ -297,7 +394,7 @@ def reuse_game_code(request):
 
         send_channel_message(code,
                              {"type": "new_game"})
-        timer_tick(new_game.id)
+        notify_game_clock(new_game.id)
 
         response = HttpResponse(status=200)
         return response
@@ -314,12 +411,14 @@ def close_game_code(request):
         if not game:
             return HttpResponse(status=404)
 
-        Game.objects.filter(code=code, status=GameStatus.COMPLETE, owner=player).update(closed=True)
+        Game.objects.filter(code=code, status=GameStatus.COMPLETE, owner=player).update(
+            closed=True, version=F('version') + 1)
+        release_game_code(code)
 
         send_channel_message(code, {"type": "close_game"})
 
         response = HttpResponse(status=200)
-        _set_player_cookie(response, player)
+        set_player_cookie(response, player)
         return response
 
 
@@ -339,9 +438,10 @@ def cancel_game_code(request, code):
         game.status = GameStatus.ABANDONED
         game.scoring_results['status'] = f"Cancelled by owner: {timezone.now().isoformat()}"
         game.save()
+        release_game_code(code)
 
         response = HttpResponse(status=200)
-        _set_player_cookie(response, player)
+        set_player_cookie(response, player)
         return response
 
 
@@ -360,7 +460,7 @@ def dev_pages(request):
             text_len=5)
     }
     response = HttpResponse(template.render(context, request))
-    _set_player_cookie(response, player)
+    set_player_cookie(response, player)
     return response
 
 
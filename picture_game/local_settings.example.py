@@ -78,6 +78,9 @@ DATABASES = {
     }
 }
 
+# The game clock's queue, the game code pool and the default cache, where
+# running games keep their state, all live here. Set CACHES to put the cache
+# somewhere else.
 REDIS_URL = 'redis://localhost:6379/0'
 
 MEDIA_URL = "media/"
@@ -11,16 +11,51 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+REDIS_URL = 'redis://localhost:6379/0'
+
+CACHES = {
+    'default': {
+        # Running games keep their hot state in the cache, so every process
+        # (web and clock) has to share it. Whatever local settings put here
+        # must not be a cache of the process's own, like LocMemCache. It
+        # lives on the Redis at REDIS_URL unless local settings say otherwise.
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+    },
+    'fragments': {
+        # Rendered game pages are keyed on the game's version and never go
+        # stale, so each process keeps its own and the least recently used
+        # are dropped once it fills up.
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'game-fragments',
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+}
+
 try:
     from .local_settings import *
 except ImportError:
     pass
 
+CACHES['default'].setdefault('LOCATION', REDIS_URL)
+
+if 'test' in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        # The test database hands out the same ids again after each test
+        # rolls back, so cached pages could belong to some other game.
+        'fragments': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        },
+    }
+
 # Application definition
 
 INSTALLED_APPS = [